@@ -9,8 +9,10 @@ from airflow import DAG
 from airflow.operators.python_operator import PythonOperator
 from influxdb import InfluxDBClient
 from influxdb import DataFrameClient
-from energy_injector_methods import (create_and_write_energy_for_user,
-                                     get_user_list)
+from energy_injector_methods import (create_and_write_features_for_user,
+                                     create_feature_definitions,
+                                     get_user_list,
+                                     refresh_user_catalog)
 
 run_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -28,7 +30,29 @@ motion_acm_constants = config["Motion Accelerometer"]
 FIVE_SEC_THRESHOLD = motion_acm_constants["five_sec_threshold"]
 ONE_MIN_THRESHOLD = motion_acm_constants["one_min_threshold"]
 MAX_SUCCESSIVE_TIME_DIFF = motion_acm_constants["max_successive_time_diff"]
-ACCELEROMETER_MEASUREMENT_NAME = "MotionAccelerometer"
+
+motion_gyro_constants = config["Motion Gyroscope"]
+GYRO_FIVE_SEC_THRESHOLD = motion_gyro_constants["five_sec_threshold"]
+GYRO_ONE_MIN_THRESHOLD = motion_gyro_constants["one_min_threshold"]
+
+rr_interval_constants = config["RR Interval"]
+HRV_AGGREGATION_TIME = rr_interval_constants["hrv_aggregation_time"]
+HRV_COUNT_THRESHOLD = rr_interval_constants["hrv_count_threshold"]
+
+# When accelerometer energy is computed at ingestion time, it is only read back from InfluxDB
+# for the days with late samples or failed writes
+streaming_energy_constants = config["Streaming Energy"]
+IS_STREAMING_ENERGY_ENABLED = streaming_energy_constants.getboolean("enabled")
+ENERGY_REPAIR_PATH = streaming_energy_constants["repair_path"]
+
+FEATURE_DEFINITIONS = create_feature_definitions(FIVE_SEC_THRESHOLD, ONE_MIN_THRESHOLD, MAX_SUCCESSIVE_TIME_DIFF,
+                                                 GYRO_FIVE_SEC_THRESHOLD, GYRO_ONE_MIN_THRESHOLD,
+                                                 HRV_AGGREGATION_TIME, HRV_COUNT_THRESHOLD,
+                                                 accelerometer_energy_at_ingestion=IS_STREAMING_ENERGY_ENABLED)
+
+user_catalog_constants = config["User Catalog"]
+USER_CATALOG_PATH = user_catalog_constants["catalog_path"]
+USER_CATALOG_TTL = float(user_catalog_constants["ttl_seconds"])
 
 # see InfluxDB Python API for more information
 # https://influxdb-python.readthedocs.io/en/latest/api-documentation.html
@@ -38,7 +62,7 @@ DF_CLIENT = DataFrameClient(host=HOST, port=PORT, username=USER, password=PASSWO
                             database=DB_NAME)
 print("[Client created]")
 
-user_list = get_user_list(CLIENT)
+user_list = get_user_list(CLIENT, user_catalog_path=USER_CATALOG_PATH)
 print("Users : " + str(user_list))
 
 airflow_config = config["Airflow"]
@@ -59,16 +83,25 @@ default_args = {
 
 dag = DAG('energy_data_injector', default_args=default_args, schedule_interval="@daily")
 
+# The catalog is refreshed in a task since its queries are too long to run while the DAG is imported
+refresh_catalog = PythonOperator(task_id='refresh_user_catalog',
+                                 python_callable=refresh_user_catalog,
+                                 op_kwargs={"client": CLIENT,
+                                            "user_catalog_path": USER_CATALOG_PATH,
+                                            "user_catalog_ttl": USER_CATALOG_TTL,
+                                            "feature_definitions": FEATURE_DEFINITIONS,
+                                            },
+                                 dag=dag)
+
 for user in user_list:
     write_energy_data = PythonOperator(task_id='create_and_write_energy_for_user',
-                                       python_callable=create_and_write_energy_for_user,
+                                       python_callable=create_and_write_features_for_user,
                                        op_kwargs={"user_id": user,
                                                   "client": CLIENT,
                                                   "df_client": DF_CLIENT,
-                                                  "accelerometer_measurement_name": ACCELEROMETER_MEASUREMENT_NAME,
-                                                  "five_sec_threshold": FIVE_SEC_THRESHOLD,
-                                                  "one_min_threshold": ONE_MIN_THRESHOLD,
-                                                  "max_successive_time_diff": MAX_SUCCESSIVE_TIME_DIFF,
+                                                  "feature_definitions": FEATURE_DEFINITIONS,
+                                                  "user_catalog_path": USER_CATALOG_PATH,
+                                                  "energy_repair_path": ENERGY_REPAIR_PATH,
                                                   },
                                        dag=dag)
-    write_energy_data
\ No newline at end of file
+    write_energy_data.set_upstream(refresh_catalog)
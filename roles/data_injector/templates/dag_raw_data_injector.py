@@ -11,6 +11,7 @@ from influxdb import InfluxDBClient
 from influxdb import DataFrameClient
 from influxdb_raw_data_injector import (execute_acm_gyro_files_write_pipeline,
                                         execute_rri_files_write_pipeline)
+from energy_injector_methods import create_streaming_energy_parameters
 
 run_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -29,6 +30,29 @@ PORT = int(influxdb_client_constants["port"])
 USER = influxdb_client_constants["user"]
 PASSWORD = influxdb_client_constants["password"]
 
+user_catalog_constants = config["User Catalog"]
+USER_CATALOG_PATH = user_catalog_constants["catalog_path"]
+
+write_buffer_constants = config["Write Buffer"]
+MAX_BATCH_POINTS = int(write_buffer_constants["max_batch_points"])
+MAX_BATCH_AGE_SECONDS = float(write_buffer_constants["max_batch_age_seconds"])
+
+large_files_constants = config["Large Files"]
+LARGE_FILE_SIZE_BYTES = int(large_files_constants["size_threshold_bytes"])
+DATA_BLOCK_SIZE = int(large_files_constants["block_size"])
+
+motion_acm_constants = config["Motion Accelerometer"]
+streaming_energy_constants = config["Streaming Energy"]
+ENERGY_REPAIR_PATH = streaming_energy_constants["repair_path"]
+if streaming_energy_constants.getboolean("enabled"):
+    STREAMING_ENERGY_STATE_PATH = streaming_energy_constants["state_path"]
+    STREAMING_ENERGY_PARAMETERS = create_streaming_energy_parameters(motion_acm_constants["five_sec_threshold"],
+                                                                     motion_acm_constants["one_min_threshold"],
+                                                                     motion_acm_constants["max_successive_time_diff"])
+else:
+    STREAMING_ENERGY_STATE_PATH = None
+    STREAMING_ENERGY_PARAMETERS = None
+
 # see InfluxDB Python API for more information
 # https://influxdb-python.readthedocs.io/en/latest/api-documentation.html
 CLIENT = InfluxDBClient(host=HOST, port=PORT, username=USER, password=PASSWORD,
@@ -66,7 +90,10 @@ write_rri_data = PythonOperator(task_id='write_rri_data_into_influxDB',
                                            "path_for_written_files": PATH_FOR_WRITTEN_FILES,
                                            "path_for_problems_files": PATH_FOR_PROBLEMS_FILES,
                                            "df_client": DF_CLIENT,
-                                           "verbose": True},
+                                           "verbose": True,
+                                           "user_catalog_path": USER_CATALOG_PATH,
+                                           "large_file_size_bytes": LARGE_FILE_SIZE_BYTES,
+                                           "block_size": DATA_BLOCK_SIZE},
                                 dag=dag)
 
 write_acm_gyro_data = PythonOperator(task_id='write_acm_gyro_data_into_influxDB',
@@ -75,7 +102,15 @@ write_acm_gyro_data = PythonOperator(task_id='write_acm_gyro_data_into_influxDB'
                                                 "path_for_written_files": PATH_FOR_WRITTEN_FILES,
                                                 "path_for_problems_files": PATH_FOR_PROBLEMS_FILES,
                                                 "df_client": DF_CLIENT,
-                                                "verbose": True},
+                                                "verbose": True,
+                                                "user_catalog_path": USER_CATALOG_PATH,
+                                                "streaming_energy_state_path": STREAMING_ENERGY_STATE_PATH,
+                                                "streaming_energy_parameters": STREAMING_ENERGY_PARAMETERS,
+                                                "max_batch_points": MAX_BATCH_POINTS,
+                                                "max_batch_age_seconds": MAX_BATCH_AGE_SECONDS,
+                                                "large_file_size_bytes": LARGE_FILE_SIZE_BYTES,
+                                                "block_size": DATA_BLOCK_SIZE,
+                                                "energy_repair_path": ENERGY_REPAIR_PATH},
                                      dag=dag)
 
 write_acm_gyro_data.set_upstream(write_rri_data)
\ No newline at end of file
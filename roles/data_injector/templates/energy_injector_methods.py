@@ -3,6 +3,10 @@
 """This script defines methods to compute features from InfluxDB Data"""
 
 from typing import List
+import os
+import copy
+import json
+import fcntl
 import math
 import datetime
 import configparser
@@ -10,6 +14,8 @@ import numpy as np
 import pandas as pd
 from influxdb import InfluxDBClient
 from influxdb import DataFrameClient
+from user_catalog_methods import (get_catalog, get_catalog_timestamp, get_catalog_user_list,
+                                  load_catalog, save_catalog, update_catalog_with_dataframe)
 
 # JSON field values
 TYPE_PARAM_NAME = "type"
@@ -17,19 +23,35 @@ USER_PARAM_NAME = "user"
 DEVICE_PARAM_NAME = "device_address"
 
 ACCELEROMETER_MEASUREMENT_NAME = "MotionAccelerometer"
+GYROSCOPE_MEASUREMENT_NAME = "MotionGyroscope"
+RR_INTERVAL_MEASUREMENT_NAME = "RrInterval"
+
+ACCELEROMETER_FIELDS = ["x_acm", "y_acm", "z_acm"]
+GYROSCOPE_FIELDS = ["x_gyro", "y_gyro", "z_gyro"]
+RR_INTERVAL_FIELDS = ["RrInterval"]
 
 # --------------------- FUNCTIONS TO QUERY INFLUXDB --------------------- #
 
 
-def get_user_list(client) -> List[str]:
+def get_user_list(client, user_catalog_path: str = None) -> List[str]:
     """
     Get the list of all distinct user in the influxDB database.
     Arguments
     ---------
     client: Client object
         influxDB client to connect to database.
+    user_catalog_path: str
+        path of the user catalog. If given, users are read from the catalog whatever its age,
+        since the ingestion adds new users to it, and InfluxDB is only queried when the catalog
+        has no user yet. The catalog is never refreshed here since this function is called when
+        the DAG file is imported, see refresh_user_catalog.
     :return usr_list: list of all distinct user in database.
     """
+    if user_catalog_path is not None:
+        catalog_user_list = get_catalog_user_list(load_catalog(user_catalog_path))
+        if catalog_user_list:
+            return catalog_user_list
+
     # Get list of all users
     influx_query = "SHOW TAG VALUES WITH KEY = \"user\""
     query_result = client.query(influx_query)
@@ -42,7 +64,21 @@ def get_user_list(client) -> List[str]:
     return list(set(usr_list))
 
 
-def extract_raw_data_from_influxdb(client, measurement: str, user_id: str, start_time: str, end_time: str):
+def refresh_user_catalog(client, user_catalog_path: str, user_catalog_ttl: float = 3600,
+                         feature_definitions: List[dict] = None):
+    """
+    Refresh the user catalog from InfluxDB if it is older than user_catalog_ttl seconds.
+    :param client:
+    :param user_catalog_path:
+    :param user_catalog_ttl:
+    :param feature_definitions: definitions whose reference feature last timestamps are refreshed
+    """
+    get_catalog(client, user_catalog_path, user_catalog_ttl,
+                get_reference_features_by_measurement(feature_definitions or []))
+
+
+def extract_raw_data_from_influxdb(client, measurement: str, user_id: str, start_time: str, end_time: str,
+                                   fields: List[str] = None):
     """
     TODO
     :param client:
@@ -50,13 +86,35 @@ def extract_raw_data_from_influxdb(client, measurement: str, user_id: str, start
     :param user_id:
     :param start_time:
     :param end_time:
+    :param fields: fields to extract, all fields are extracted if None
     :return extracted_result_set: influxDB object containing extracted data
     """
+    selected_fields = "*" if fields is None else ", ".join("\"{}\"".format(field) for field in fields)
     # Extract raw data from InfluxDB for D-day
-    query = "SELECT * FROM {} WHERE \"user\" = '{}' and time > now() - {} and time < now() - {}".format(measurement,
-                                                                                                        user_id,
-                                                                                                        start_time,
-                                                                                                        end_time)
+    query = "SELECT {} FROM {} WHERE \"user\" = '{}' and time > now() - {} and time < now() - {}".format(selected_fields,
+                                                                                                         measurement,
+                                                                                                         user_id,
+                                                                                                         start_time,
+                                                                                                         end_time)
+    extracted_result_set = client.query(query)
+    return extracted_result_set
+
+
+def extract_raw_data_between_timestamps(client, measurement: str, user_id: str, start_timestamp, end_timestamp,
+                                        fields: List[str] = None):
+    """
+    :param client:
+    :param measurement:
+    :param user_id:
+    :param start_timestamp: UTC start of the range
+    :param end_timestamp: UTC end of the range (excluded)
+    :param fields: fields to extract, all fields are extracted if None
+    :return extracted_result_set: influxDB object containing extracted data
+    """
+    selected_fields = "*" if fields is None else ", ".join("\"{}\"".format(field) for field in fields)
+    query = "SELECT {} FROM {} WHERE \"user\" = '{}' and time >= '{}' and time < '{}'".format(
+        selected_fields, measurement, user_id, start_timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        end_timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"))
     extracted_result_set = client.query(query)
     return extracted_result_set
 
@@ -64,30 +122,64 @@ def extract_raw_data_from_influxdb(client, measurement: str, user_id: str, start
 # --------------------- FUNCTIONS TO COMPUTE TIME RANGE TO QUERY --------------------- #
 
 
-def get_first_timestamp_to_compute_energy(user_id: str, client):
+def get_first_timestamp_to_compute_features(user_id: str, client, measurement: str, raw_field: str,
+                                            reference_feature: str, user_catalog: dict = None):
     """
+    Get the timestamp from which features have to be computed: the last timestamp of the reference
+    feature if it exists, otherwise the first timestamp of the raw data. The user catalog is read
+    first and InfluxDB is only queried for what the catalog does not know.
     :param user_id:
     :param client:
+    :param measurement: measurement containing the raw data and the features
+    :param raw_field: raw field used to find the first raw timestamp
+    :param reference_feature: feature field used to find the last computed timestamp
+    :param user_catalog: user catalog used instead of querying InfluxDB when it knows the user
     :return:
     """
-    query = "SELECT last(\"energy_by_5s\") FROM MotionAccelerometer WHERE \"user\" = '{}'".format(user_id)
+    if user_catalog is not None:
+        last_feature_timestamp = get_catalog_timestamp(user_catalog, user_id, measurement, reference_feature, "last")
+        if last_feature_timestamp is not None:
+            print("Last {} timestamp from user catalog: {}".format(reference_feature, last_feature_timestamp))
+            return pd.to_datetime(last_feature_timestamp, unit="ns")
+
+    # The catalog may not track the reference feature yet, InfluxDB is queried before
+    # computing features from all raw data
+    query = "SELECT last(\"{}\") FROM {} WHERE \"user\" = '{}'".format(reference_feature, measurement, user_id)
     extracted_data_result_set = client.query(query)
-    last_energy_timestamp_for_user = list(extracted_data_result_set.get_points())
-
-    if last_energy_timestamp_for_user:
-        # Get last timestamp of energy data for user
-        first_timestamp_to_compute_energy = last_energy_timestamp_for_user[0]["time"]
-        print("Last energy timestamp in time series db: {}".format(first_timestamp_to_compute_energy))
-    else:
-        # Get first timestamp of Accelerometer data for user
-        print("No energy data for user : {}".format(user_id))
-        print("[Calculating energy from all MotionAccelerometer data]")
-        query = "SELECT first(\"x_acm\") FROM MotionAccelerometer WHERE \"user\" = '{}'".format(user_id)
+    last_feature_timestamp_for_user = list(extracted_data_result_set.get_points())
+
+    if last_feature_timestamp_for_user:
+        # Get last timestamp of feature data for user
+        first_timestamp_to_compute = last_feature_timestamp_for_user[0]["time"]
+        print("Last {} timestamp in time series db: {}".format(reference_feature, first_timestamp_to_compute))
+        return pd.to_datetime(first_timestamp_to_compute, unit="ns")
+
+    # Get first timestamp of raw data for user
+    print("No {} data for user : {}".format(reference_feature, user_id))
+    print("[Calculating features from all {} data]".format(measurement))
+    first_timestamp_to_compute = None
+    if user_catalog is not None:
+        first_timestamp_to_compute = get_catalog_timestamp(user_catalog, user_id, measurement, raw_field, "first")
+    if first_timestamp_to_compute is None:
+        query = "SELECT first(\"{}\") FROM {} WHERE \"user\" = '{}'".format(raw_field, measurement, user_id)
         extracted_data_result_set = client.query(query)
-        first_acm_timestamp_for_user = list(extracted_data_result_set.get_points())
-        first_timestamp_to_compute_energy = first_acm_timestamp_for_user[0]["time"]
+        first_raw_timestamp_for_user = list(extracted_data_result_set.get_points())
+        if not first_raw_timestamp_for_user:
+            return None
+        first_timestamp_to_compute = first_raw_timestamp_for_user[0]["time"]
+
+    return pd.to_datetime(first_timestamp_to_compute, unit="ns")
 
-    return pd.to_datetime(first_timestamp_to_compute_energy, unit="ns")
+
+def get_first_timestamp_to_compute_energy(user_id: str, client, user_catalog: dict = None):
+    """
+    :param user_id:
+    :param client:
+    :param user_catalog: user catalog used instead of querying InfluxDB when it knows the user
+    :return:
+    """
+    return get_first_timestamp_to_compute_features(user_id, client, ACCELEROMETER_MEASUREMENT_NAME, "x_acm",
+                                                   "energy_by_5s", user_catalog=user_catalog)
 
 
 def get_time_difference_between_now_and_timestamp(timestamp):
@@ -102,7 +194,25 @@ def get_time_difference_between_now_and_timestamp(timestamp):
     return time_delta.days
 
 
-# --------------------- FUNCTIONS TO COMPUTE ENERGY FROM ACM QUERY RESULT --------------------- #
+# --------------------- FUNCTIONS TO COMPUTE FEATURES FROM QUERY RESULT --------------------- #
+
+
+def transform_result_set_into_dataframe(result_set, measurement: str, fields: List[str],
+                                        tags: dict = None) -> pd.DataFrame:
+    """
+    Transform an InfluxDB ResultSet into a pandas DataFrame indexed by time.
+    :param result_set:
+    :param measurement:
+    :param fields: raw fields to keep
+    :param tags: tags to filter points on, only for queries returning tag columns such as SELECT *.
+    Queries selecting fields already filter the user in their WHERE clause and return no tag.
+    :return:
+    """
+    raw_data_list = list(result_set.get_points(measurement=measurement, tags=tags))
+    raw_dataframe = pd.DataFrame(raw_data_list)[["time"] + fields]
+    raw_dataframe["time"] = pd.to_datetime(raw_dataframe["time"])
+    raw_dataframe.index = raw_dataframe["time"]
+    return raw_dataframe.dropna()
 
 
 def transform_acm_result_set_into_dataframe(result_set: str, tags: dict) -> pd.DataFrame:
@@ -112,51 +222,250 @@ def transform_acm_result_set_into_dataframe(result_set: str, tags: dict) -> pd.D
     :param tags:
     :return:
     """
-    raw_acm_data_list = list(result_set.get_points(measurement=ACCELEROMETER_MEASUREMENT_NAME, tags=tags))
-    raw_acm_dataframe = pd.DataFrame(raw_acm_data_list)[["time", "x_acm", "y_acm", "z_acm"]]
-    raw_acm_dataframe["time"] = pd.to_datetime(raw_acm_dataframe["time"])
-    raw_acm_dataframe.index = raw_acm_dataframe["time"]
-    return raw_acm_dataframe.dropna()
+    return transform_result_set_into_dataframe(result_set, ACCELEROMETER_MEASUREMENT_NAME,
+                                               ACCELEROMETER_FIELDS, tags)
+
+
+def _to_datetime_index(times: np.ndarray, index_tz=None) -> pd.DatetimeIndex:
+    datetime_index = pd.DatetimeIndex(pd.to_datetime(times, unit="ns"), name="timestamp")
+    if index_tz is not None:
+        datetime_index = datetime_index.tz_localize("UTC").tz_convert(index_tz)
+    return datetime_index
+
+
+def create_session_index(times: np.ndarray, max_successive_time_diff) -> np.ndarray:
+    """
+    Find the contiguous recording sessions of a time sorted array of timestamps: a new session
+    starts after every gap larger than or equal to max_successive_time_diff.
+    :param times: int64 nanoseconds timestamps
+    :param max_successive_time_diff:
+    :return session_index: (nb_sessions, 2) array of [start, end) offsets in times
+    """
+    if len(times) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    session_boundaries = np.flatnonzero(np.diff(times) >= pd.Timedelta(max_successive_time_diff).value) + 1
+    session_starts = np.concatenate(([0], session_boundaries))
+    session_ends = np.concatenate((session_boundaries, [len(times)]))
+    return np.column_stack((session_starts, session_ends))
+
+
+def create_session_statistics_dataframe(times: np.ndarray, session_index: np.ndarray,
+                                        index_tz=None) -> pd.DataFrame:
+    """
+    Compute the duration, number of samples and sample rate of each recording session.
+    :param times: int64 nanoseconds timestamps
+    :param session_index: session index created by create_session_index
+    :param index_tz: time zone of the resulting index
+    :return session_statistics_dataframe: dataframe indexed by session start time
+    """
+    session_starts, session_ends = session_index[:, 0], session_index[:, 1]
+    session_nb_samples = session_ends - session_starts
+    session_durations = (times[session_ends - 1] - times[session_starts]) / 1e9
+    with np.errstate(divide="ignore", invalid="ignore"):
+        session_sample_rates = np.where(session_durations > 0, (session_nb_samples - 1) / session_durations, 0.)
+
+    session_statistics_dataframe = pd.DataFrame({"session_duration": session_durations,
+                                                 "session_nb_samples": session_nb_samples,
+                                                 "session_sample_rate": session_sample_rates},
+                                                index=_to_datetime_index(times[session_starts], index_tz))
+    return session_statistics_dataframe
+
+
+def aggregate_by_window(times: np.ndarray, values: np.ndarray, aggregation_time: str) -> tuple:
+    """
+    Sum values by time window. Windows are labelled by their right edge, as resample(label="right")
+    does, and only windows containing values are returned.
+    :param times: int64 nanoseconds timestamps
+    :param values: values to sum
+    :param aggregation_time:
+    :return window_ends, window_sums, window_counts:
+    """
+    window_length = pd.Timedelta(aggregation_time).value
+    window_ends, window_indexes = np.unique((times // window_length + 1) * window_length, return_inverse=True)
+    window_sums = np.bincount(window_indexes, weights=values, minlength=len(window_ends))
+    window_counts = np.bincount(window_indexes, minlength=len(window_ends))
+    return window_ends, window_sums, window_counts
 
 
 def create_energy_dataframe(acm_dataframe: pd.DataFrame, aggregation_count_threshold: int,
-                            max_successive_time_diff: str, aggregation_time: str) -> pd.DataFrame:
+                            max_successive_time_diff: str, aggregation_time: str,
+                            feature_name: str = "energy", session_index: np.ndarray = None) -> pd.DataFrame:
     """
-    TODO
-    :param acm_dataframe:
+    Compute the sum of the norms of successive triaxial differences by time window. It is used
+    for the accelerometer energy and for the gyroscope rotational energy. Differences between
+    two recording sessions are ignored.
+    :param acm_dataframe: time sorted triaxial dataframe with a "time" column
     :param aggregation_count_threshold:
     :param max_successive_time_diff:
     :param aggregation_time:
+    :param feature_name: prefix of the resulting column name
+    :param session_index: session index of acm_dataframe, computed if not given
     :return:
     """
-    max_successive_time_diff_boolean_mask = acm_dataframe["time"].diff(periods=1) < max_successive_time_diff
-    consecutive_differences_dataframe = acm_dataframe.diff(periods=1)[max_successive_time_diff_boolean_mask].drop(["time"], axis=1)
+    times = acm_dataframe.index.values.astype("datetime64[ns]").astype(np.int64)
+    if session_index is None:
+        session_index = create_session_index(times, max_successive_time_diff)
+
+    # Differences are computed once on the whole day, the one crossing each session start is dropped
+    values = acm_dataframe.drop(["time"], axis=1).values.astype(np.float64)
+    triaxial_sqrt_array = np.sqrt((np.diff(values, axis=0) ** 2).sum(axis=1))
+    in_session_boolean_mask = np.ones(len(triaxial_sqrt_array), dtype=bool)
+    in_session_boolean_mask[session_index[1:, 0] - 1] = False
+
+    window_ends, window_sums, window_counts = aggregate_by_window(times[1:][in_session_boolean_mask],
+                                                                  triaxial_sqrt_array[in_session_boolean_mask],
+                                                                  aggregation_time)
+    count_threshold_boolean_mask = window_counts > aggregation_count_threshold
+    energy_dataframe = pd.DataFrame(window_sums[count_threshold_boolean_mask],
+                                    index=_to_datetime_index(window_ends[count_threshold_boolean_mask],
+                                                             acm_dataframe.index.tz),
+                                    columns=["{}_by_{}".format(feature_name, aggregation_time)])
+    return energy_dataframe
 
-    squared_differences_dataframe = consecutive_differences_dataframe ** 2
-    triaxial_sum_series = squared_differences_dataframe.apply(sum, axis=1)
-    triaxial_sqrt_dataframe = triaxial_sum_series.apply(np.sqrt).to_frame()
 
-    acm_dataframe_index = acm_dataframe[max_successive_time_diff_boolean_mask]["time"]
-    triaxial_sqrt_dataframe.index = acm_dataframe_index
-    triaxial_sqrt_dataframe.index.name = "timestamp"
+def create_hrv_dataframe(rri_dataframe: pd.DataFrame, aggregation_count_threshold: int,
+                         aggregation_time: str) -> pd.DataFrame:
+    """
+    Compute time domain heart rate variability metrics (mean RR, SDNN and RMSSD) by time window.
+    :param rri_dataframe: dataframe with a "RrInterval" column in milliseconds
+    :param aggregation_count_threshold: minimum number of RR-intervals in a window
+    :param aggregation_time:
+    :return:
+    """
+    rri_series = rri_dataframe["RrInterval"]
+    squared_successive_differences_series = rri_series.diff(periods=1) ** 2
+
+    rri_resampler = rri_series.resample(aggregation_time, label="right")
+    hrv_dataframe = pd.DataFrame({
+        "mean_rr_by_{}".format(aggregation_time): rri_resampler.mean(),
+        "sdnn_by_{}".format(aggregation_time): rri_resampler.std(),
+        "rmssd_by_{}".format(aggregation_time): np.sqrt(
+            squared_successive_differences_series.resample(aggregation_time, label="right").mean()),
+    })
+    hrv_dataframe.index.name = "timestamp"
 
-    count_threshold_boolean_mask = triaxial_sqrt_dataframe.resample(aggregation_time, label="right").count() > aggregation_count_threshold
-    energy_dataframe = triaxial_sqrt_dataframe.resample(aggregation_time, label="right").sum()
-    energy_dataframe = energy_dataframe[count_threshold_boolean_mask].dropna()
-    energy_dataframe = energy_dataframe.rename(columns={0: "energy_by_{}".format(aggregation_time)})
+    count_threshold_boolean_mask = rri_resampler.count() > aggregation_count_threshold
+    return hrv_dataframe[count_threshold_boolean_mask].dropna()
+
+
+# --------------------- FEATURE ENGINE --------------------- #
+
+
+def create_feature_definitions(five_sec_threshold, one_min_threshold, max_successive_time_diff,
+                               gyro_five_sec_threshold=None, gyro_one_min_threshold=None,
+                               hrv_aggregation_time=None, hrv_count_threshold=None,
+                               accelerometer_energy_at_ingestion=False) -> List[dict]:
+    """
+    Create the list of feature definitions run by the feature engine. Each definition describes
+    the raw fields to extract from a measurement once per user-day and the feature functions to
+    apply to the resulting dataframe. Gyroscope and RR-interval features are only defined when
+    their parameters are given.
+    :param five_sec_threshold: minimum number of accelerometer samples in a 5s window
+    :param one_min_threshold: minimum number of accelerometer samples in a 1min window
+    :param max_successive_time_diff: maximum gap between two successive motion samples
+    :param gyro_five_sec_threshold: minimum number of gyroscope samples in a 5s window
+    :param gyro_one_min_threshold: minimum number of gyroscope samples in a 1min window
+    :param hrv_aggregation_time: window of the heart rate variability metrics
+    :param hrv_count_threshold: minimum number of RR-intervals in a heart rate variability window
+    :param accelerometer_energy_at_ingestion: True when energy is computed at ingestion time, the daily
+    job then only recomputes the days listed in the energy repair file
+    :return feature_definitions:
+    """
+    max_successive_time_diff = pd.Timedelta(max_successive_time_diff)
+    feature_definitions = []
+
+    feature_definitions.append({
+        "measurement": ACCELEROMETER_MEASUREMENT_NAME,
+        "raw_fields": ACCELEROMETER_FIELDS,
+        "reference_feature": "energy_by_5s",
+        "max_successive_time_diff": max_successive_time_diff,
+        "computed_at_ingestion": accelerometer_energy_at_ingestion,
+        "features": [
+            (create_energy_dataframe, {"aggregation_count_threshold": int(five_sec_threshold),
+                                       "max_successive_time_diff": max_successive_time_diff,
+                                       "aggregation_time": "5s"}),
+            (create_energy_dataframe, {"aggregation_count_threshold": int(one_min_threshold),
+                                       "max_successive_time_diff": max_successive_time_diff,
+                                       "aggregation_time": "1min"}),
+        ]
+    })
+
+    if gyro_five_sec_threshold is not None and gyro_one_min_threshold is not None:
+        feature_definitions.append({
+            "measurement": GYROSCOPE_MEASUREMENT_NAME,
+            "raw_fields": GYROSCOPE_FIELDS,
+            "reference_feature": "rotational_energy_by_5s",
+            "max_successive_time_diff": max_successive_time_diff,
+            "features": [
+                (create_energy_dataframe, {"aggregation_count_threshold": int(gyro_five_sec_threshold),
+                                           "max_successive_time_diff": max_successive_time_diff,
+                                           "aggregation_time": "5s",
+                                           "feature_name": "rotational_energy"}),
+                (create_energy_dataframe, {"aggregation_count_threshold": int(gyro_one_min_threshold),
+                                           "max_successive_time_diff": max_successive_time_diff,
+                                           "aggregation_time": "1min",
+                                           "feature_name": "rotational_energy"}),
+            ]
+        })
+
+    if hrv_aggregation_time is not None and hrv_count_threshold is not None:
+        feature_definitions.append({
+            "measurement": RR_INTERVAL_MEASUREMENT_NAME,
+            "raw_fields": RR_INTERVAL_FIELDS,
+            "reference_feature": "mean_rr_by_{}".format(hrv_aggregation_time),
+            "features": [
+                (create_hrv_dataframe, {"aggregation_count_threshold": int(hrv_count_threshold),
+                                        "aggregation_time": hrv_aggregation_time}),
+            ]
+        })
+
+    return feature_definitions
+
+
+def get_reference_features_by_measurement(feature_definitions: List[dict]) -> dict:
+    """
+    Get the reference feature of each measurement, whose last timestamp tells from where
+    features have to be computed.
+    :param feature_definitions: list of definitions created by create_feature_definitions
+    :return reference_features_by_measurement: ex : {"RrInterval": ["mean_rr_by_5min"]}
+    """
+    reference_features_by_measurement = dict()
+    for feature_definition in feature_definitions:
+        reference_features_by_measurement.setdefault(feature_definition["measurement"], []).append(
+            feature_definition["reference_feature"])
+    return reference_features_by_measurement
 
-    return energy_dataframe
+
+def compute_features_for_dataframe(raw_dataframe: pd.DataFrame, features: list,
+                                   session_index: np.ndarray = None) -> List[pd.DataFrame]:
+    """
+    Apply every feature function of a definition to the same raw dataframe.
+    :param raw_dataframe:
+    :param features: list of (feature_function, kwargs) tuples
+    :param session_index: session index of raw_dataframe, given to every feature function if not None
+    :return feature_dataframe_list: list of non empty feature dataframes
+    """
+    feature_dataframe_list = []
+    for feature_function, feature_kwargs in features:
+        if session_index is not None:
+            feature_kwargs = dict(feature_kwargs, session_index=session_index)
+        feature_dataframe = feature_function(raw_dataframe, **feature_kwargs)
+        if not feature_dataframe.empty:
+            feature_dataframe_list.append(feature_dataframe)
+    return feature_dataframe_list
 
 
 # --------------------- FUNCTIONS TO WRITE ENERGY DATA IN INFLUXDB --------------------- #
 
 
 def chunk_and_write_dataframe(dataframe_to_write: pd.DataFrame, measurement: str,
-                              user_id: str, df_client, batch_size: int = 5000) -> bool:
+                              user_id: str, df_client, batch_size: int = 5000,
+                              user_catalog: dict = None) -> bool:
     """
     :param dataframe_to_write:
     :param measurement:
     :param user_id:
+    :param user_catalog: user catalog updated with the written timestamps
     :return:
     """
     # Chunk dataframe for time series db performance issues
@@ -167,54 +476,362 @@ def chunk_and_write_dataframe(dataframe_to_write: pd.DataFrame, measurement: str
     for chunk in dataframe_chunk_list:
         tags = {USER_PARAM_NAME: user_id}
         df_client.write_points(chunk, measurement=measurement, tags=tags, protocol="json")
+
+    if user_catalog is not None:
+        update_catalog_with_dataframe(user_catalog, measurement, {USER_PARAM_NAME: user_id}, dataframe_to_write,
+                                      fields=list(dataframe_to_write.columns))
     return True
 
 
-def create_and_write_energy_for_user(user_id, client, df_client, accelerometer_measurement_name,
-                                     five_sec_threshold, one_min_threshold, max_successive_time_diff,
-                                     batch_size=5000):
+def write_features_for_result_set(extracted_result_set, user_id, df_client, feature_definition, batch_size=5000,
+                                  user_catalog=None):
+    """
+    Compute and write all the features of a definition from the raw data extracted for a day.
+    :param extracted_result_set: raw data of the measurement of the definition
+    :param user_id:
+    :param df_client:
+    :param feature_definition: definition created by create_feature_definitions
+    :param batch_size:
+    :param user_catalog: user catalog updated with the written timestamps
+    """
+    measurement = feature_definition["measurement"]
+
+    # Transform InfluxDB ResultSet in pandas Dataframe if resultset is not empty
+    if not extracted_result_set:
+        return
+    raw_dataframe = transform_result_set_into_dataframe(extracted_result_set, measurement,
+                                                        feature_definition["raw_fields"])
+    print("Raw {} dataframe shape: {}".format(measurement, raw_dataframe.shape))
+
+    # Split the day into recording sessions once for all the features of the measurement
+    session_index = None
+    if "max_successive_time_diff" in feature_definition:
+        raw_dataframe = raw_dataframe.sort_index()
+        times = raw_dataframe.index.values.astype("datetime64[ns]").astype(np.int64)
+        session_index = create_session_index(times, feature_definition["max_successive_time_diff"])
+        session_statistics_dataframe = create_session_statistics_dataframe(times, session_index,
+                                                                           raw_dataframe.index.tz)
+        chunk_and_write_dataframe(session_statistics_dataframe, measurement, user_id, df_client,
+                                  batch_size=batch_size)
+
+        # Skip sparse days where no window can reach the count thresholds
+        nb_successive_differences = len(times) - len(session_index)
+        min_count_threshold = min(feature_kwargs.get("aggregation_count_threshold", 0)
+                                  for _, feature_kwargs in feature_definition["features"])
+        if nb_successive_differences <= min_count_threshold:
+            print("Not enough {} samples in sessions, day skipped".format(measurement))
+            return
+
+    # Compute all the features of the measurement and write them in influxdb
+    for feature_dataframe in compute_features_for_dataframe(raw_dataframe, feature_definition["features"],
+                                                            session_index=session_index):
+        chunk_and_write_dataframe(feature_dataframe, measurement, user_id, df_client,
+                                  batch_size=batch_size, user_catalog=user_catalog)
+
+    print("[Written process done]")
+
+
+def create_and_write_features_for_user(user_id, client, df_client, feature_definitions, batch_size=5000,
+                                       user_catalog_path=None, energy_repair_path=None):
+    """
+    Compute and write every defined feature for a user. Raw data are extracted once per
+    measurement and per day, and all the features of the measurement are computed from it.
+    Features computed at ingestion time are only recomputed for the days of the energy repair file.
+    :param user_id:
+    :param client:
+    :param df_client:
+    :param feature_definitions: list of definitions created by create_feature_definitions
+    :param batch_size:
+    :param user_catalog_path: optional path of the user catalog
+    :param energy_repair_path: optional path of the days to recompute, filled at ingestion time
+    :return:
+    """
     print("-----------------------")
     print("[Creation of features] user {}".format(user_id))
 
-    # # 1. Compute global time interval
-    first_timestamp_to_compute_energy = get_first_timestamp_to_compute_energy(user_id, client=client)
-    day_range_to_query = get_time_difference_between_now_and_timestamp(first_timestamp_to_compute_energy)
-
-    for day in reversed(range(day_range_to_query + 1)):
-        # Extract raw data from InfluxDB for D-day
-        start, end = str(day + 1) + "d", str(day) + "d"
-        extracted_result_set = extract_raw_data_from_influxdb(client, accelerometer_measurement_name,
-                                                              user_id, start, end)
-
-        # Transform InfluxDB ResultSet in pandas Dataframe if resultset is not empty
-        if extracted_result_set:
-            tags = {"user": user_id}
-            raw_acm_dataframe = transform_acm_result_set_into_dataframe(extracted_result_set, tags)
-            print("Raw dataframe shape: {}".format(raw_acm_dataframe.shape))
-        else:
+    user_catalog = load_catalog(user_catalog_path) if user_catalog_path is not None else None
+
+    for feature_definition in feature_definitions:
+        measurement = feature_definition["measurement"]
+        raw_fields = feature_definition["raw_fields"]
+
+        if feature_definition.get("computed_at_ingestion"):
+            if energy_repair_path is None:
+                continue
+            # Recompute days with late samples or failed writes at ingestion time
+            repair_days = load_energy_repair_days(energy_repair_path).get(user_id, [])
+            for day in repair_days:
+                print("[Recomputing {} features of day {}]".format(measurement, day))
+                start = pd.Timestamp(day)
+                extracted_result_set = extract_raw_data_between_timestamps(client, measurement, user_id, start,
+                                                                           start + pd.Timedelta("1D"),
+                                                                           fields=raw_fields)
+                write_features_for_result_set(extracted_result_set, user_id, df_client, feature_definition,
+                                              batch_size=batch_size, user_catalog=user_catalog)
+            if repair_days:
+                remove_energy_repair_days(energy_repair_path, user_id, repair_days)
+            continue
+
+        # # 1. Compute global time interval
+        first_timestamp_to_compute = get_first_timestamp_to_compute_features(user_id, client, measurement,
+                                                                             raw_fields[0],
+                                                                             feature_definition["reference_feature"],
+                                                                             user_catalog=user_catalog)
+        if first_timestamp_to_compute is None:
+            print("No {} data for user : {}".format(measurement, user_id))
             continue
+        day_range_to_query = get_time_difference_between_now_and_timestamp(first_timestamp_to_compute)
+
+        for day in reversed(range(day_range_to_query + 1)):
+            # Extract raw data from InfluxDB for D-day
+            start, end = str(day + 1) + "d", str(day) + "d"
+            extracted_result_set = extract_raw_data_from_influxdb(client, measurement, user_id, start, end,
+                                                                  fields=raw_fields)
+            write_features_for_result_set(extracted_result_set, user_id, df_client, feature_definition,
+                                          batch_size=batch_size, user_catalog=user_catalog)
+
+    if user_catalog is not None:
+        save_catalog(user_catalog, user_catalog_path)
+
+
+def create_and_write_energy_for_user(user_id, client, df_client, accelerometer_measurement_name,
+                                     five_sec_threshold, one_min_threshold, max_successive_time_diff,
+                                     batch_size=5000, user_catalog_path=None):
+    feature_definitions = create_feature_definitions(five_sec_threshold, one_min_threshold,
+                                                     max_successive_time_diff)
+    feature_definitions[0]["measurement"] = accelerometer_measurement_name
+    create_and_write_features_for_user(user_id, client, df_client, feature_definitions,
+                                       batch_size=batch_size, user_catalog_path=user_catalog_path)
+
+
+# --------------------- FUNCTIONS TO COMPUTE ENERGY AT INGESTION TIME --------------------- #
+
+
+def create_streaming_energy_parameters(five_sec_threshold, one_min_threshold, max_successive_time_diff) -> dict:
+    """
+    Create the parameters of the energy computed at ingestion time.
+    :param five_sec_threshold: minimum number of accelerometer samples in a 5s window
+    :param one_min_threshold: minimum number of accelerometer samples in a 1min window
+    :param max_successive_time_diff: maximum gap between two successive accelerometer samples
+    :return streaming_energy_parameters:
+    """
+    return {"aggregation_count_thresholds": {"5s": int(five_sec_threshold), "1min": int(one_min_threshold)},
+            "max_successive_time_diff": pd.Timedelta(max_successive_time_diff).value}
+
+
+def load_streaming_energy_state(state_path: str) -> dict:
+    """
+    Load the per-user state of the energy computed at ingestion time.
+    :param state_path: path of the JSON state file
+    :return streaming_energy_state: state by user, empty if the file is missing or unreadable
+    """
+    try:
+        with open(state_path) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return dict()
 
-        # 4. Compute the energy feature
-        five_sec_energy_dataframe = create_energy_dataframe(raw_acm_dataframe,
-                                                            aggregation_count_threshold=five_sec_threshold,
-                                                            max_successive_time_diff=max_successive_time_diff,
-                                                            aggregation_time="5s")
-        if not five_sec_energy_dataframe.empty:
-            # 5. Chunk resulting energy dataframe (if necessary) and write in influxdb
-            chunk_and_write_dataframe(five_sec_energy_dataframe, accelerometer_measurement_name, user_id,
-                                      df_client, batch_size=batch_size)
-
-        # 4-bis. Compute the energy feature
-        one_minute_energy_dataframe = create_energy_dataframe(raw_acm_dataframe,
-                                                              aggregation_count_threshold=one_min_threshold,
-                                                              max_successive_time_diff=max_successive_time_diff,
-                                                              aggregation_time="1min")
-        if not one_minute_energy_dataframe.empty:
-            # 5-bis. Chunk resulting energy dataframe (if necessary) and write in influxdb
-            chunk_and_write_dataframe(one_minute_energy_dataframe, accelerometer_measurement_name, user_id,
-                                      df_client, batch_size=batch_size)
-
-        print("[Written process done]")
+
+def save_streaming_energy_state(streaming_energy_state: dict, state_path: str):
+    """
+    Atomically write the per-user state of the energy computed at ingestion time.
+    :param streaming_energy_state:
+    :param state_path: path of the JSON state file
+    """
+    state_directory = os.path.dirname(state_path)
+    if state_directory and not os.path.exists(state_directory):
+        os.makedirs(state_directory)
+    temporary_path = state_path + ".tmp"
+    with open(temporary_path, "w") as state_file:
+        json.dump(streaming_energy_state, state_file)
+    os.replace(temporary_path, state_path)
+
+
+def update_streaming_energy_state(user_state: dict, acm_dataframe: pd.DataFrame,
+                                  streaming_energy_parameters: dict) -> List[pd.DataFrame]:
+    """
+    Feed new accelerometer samples into the incremental energy aggregator of a user.
+    The user state keeps the last sample, to compute the first successive difference, and the
+    sum and count of the window that is still open for each aggregation time. A window is closed,
+    and emitted, as soon as a sample at or after its end is received. Samples older than the last
+    sample of the state are left out of the aggregation and their time range is returned, so that
+    the energy of their days is recomputed by the daily job.
+    ex :
+    user_state = {
+        "last_sample": [1545066000000000000, 0.1, 9.8, 0.2],
+        "open_windows": {"5s": {"end": 1545066005000000000, "sum": 1.2, "count": 12}}
+    }
+    :param user_state: state of the user updated in place
+    :param acm_dataframe: accelerometer dataframe with a datetime index
+    :param streaming_energy_parameters: parameters created by create_streaming_energy_parameters
+    :return energy_dataframe_list, late_time_range: list of non empty dataframes of closed energy
+    windows, and (first, last) nanoseconds timestamps of the late samples or None
+    """
+    acm_dataframe = acm_dataframe.sort_index()
+    times = acm_dataframe.index.values.astype("datetime64[ns]").astype(np.int64)
+    values = acm_dataframe[ACCELEROMETER_FIELDS].values.astype(np.float64)
+
+    late_time_range = None
+    last_sample = user_state.get("last_sample")
+    if last_sample is not None:
+        in_order_boolean_mask = times > last_sample[0]
+        if not in_order_boolean_mask.all():
+            late_times = times[~in_order_boolean_mask]
+            late_time_range = (int(late_times[0]), int(late_times[-1]))
+            print("{} late samples left to the daily energy job".format(len(late_times)))
+        times = np.concatenate(([last_sample[0]], times[in_order_boolean_mask]))
+        values = np.vstack(([last_sample[1:]], values[in_order_boolean_mask]))
+    if len(times) < 2:
+        return [], late_time_range
+
+    # Norm of successive triaxial differences, dropped when the time gap is too large
+    max_successive_time_diff_boolean_mask = np.diff(times) < streaming_energy_parameters["max_successive_time_diff"]
+    triaxial_sqrt_array = np.sqrt((np.diff(values, axis=0) ** 2).sum(axis=1))[max_successive_time_diff_boolean_mask]
+    difference_times = times[1:][max_successive_time_diff_boolean_mask]
+    latest_time = int(times[-1])
+    user_state["last_sample"] = [latest_time] + values[-1].tolist()
+
+    open_windows = user_state.setdefault("open_windows", dict())
+    energy_dataframe_list = []
+    for aggregation_time, aggregation_count_threshold in streaming_energy_parameters["aggregation_count_thresholds"].items():
+        window_ends, window_sums, window_counts = aggregate_by_window(difference_times, triaxial_sqrt_array,
+                                                                      aggregation_time)
+
+        open_window = open_windows.pop(aggregation_time, None)
+        if open_window is not None:
+            if len(window_ends) and window_ends[0] == open_window["end"]:
+                window_sums[0] += open_window["sum"]
+                window_counts[0] += open_window["count"]
+            else:
+                window_ends = np.insert(window_ends, 0, open_window["end"])
+                window_sums = np.insert(window_sums, 0, open_window["sum"])
+                window_counts = np.insert(window_counts, 0, open_window["count"])
+
+        closed_windows_boolean_mask = window_ends <= latest_time
+        if not closed_windows_boolean_mask.all():
+            open_windows[aggregation_time] = {"end": int(window_ends[-1]), "sum": float(window_sums[-1]),
+                                              "count": int(window_counts[-1])}
+
+        emitted_windows_boolean_mask = closed_windows_boolean_mask & (window_counts > aggregation_count_threshold)
+        if emitted_windows_boolean_mask.any():
+            energy_dataframe = pd.DataFrame(window_sums[emitted_windows_boolean_mask],
+                                            index=_to_datetime_index(window_ends[emitted_windows_boolean_mask]),
+                                            columns=["energy_by_{}".format(aggregation_time)])
+            energy_dataframe_list.append(energy_dataframe)
+
+    return energy_dataframe_list, late_time_range
+
+
+def compute_and_write_streaming_energy(acm_dataframe: pd.DataFrame, user_id: str, df_client,
+                                       streaming_energy_state: dict, streaming_energy_parameters: dict,
+                                       energy_repair_days: dict, user_catalog: dict = None) -> bool:
+    """
+    Compute the energy of the closed windows from freshly ingested accelerometer samples and
+    write it in InfluxDB. Days whose energy can not be computed at ingestion time, because their
+    samples arrived late or because the energy write failed, are added to energy_repair_days to be
+    recomputed by the daily job. The user state is always updated so that the following samples
+    are aggregated in order.
+    :param acm_dataframe: accelerometer dataframe with a datetime index
+    :param user_id:
+    :param df_client:
+    :param streaming_energy_state: state by user updated in place
+    :param streaming_energy_parameters: parameters created by create_streaming_energy_parameters
+    :param energy_repair_days: set of days to recompute by user, updated in place
+    :param user_catalog: user catalog updated with the written timestamps
+    :return write_success:
+    """
+    user_state = copy.deepcopy(streaming_energy_state.get(user_id, dict()))
+    energy_dataframe_list, late_time_range = update_streaming_energy_state(user_state, acm_dataframe,
+                                                                           streaming_energy_parameters)
+    streaming_energy_state[user_id] = user_state
+    if late_time_range is not None:
+        energy_repair_days.setdefault(user_id, set()).update(get_days_of_time_range(*late_time_range))
+
+    try:
+        for energy_dataframe in energy_dataframe_list:
+            chunk_and_write_dataframe(energy_dataframe, ACCELEROMETER_MEASUREMENT_NAME, user_id, df_client,
+                                      user_catalog=user_catalog)
+    except:
+        print("Impossible to write streaming energy to influxDB, days left to the daily energy job")
+        max_window_length = max(pd.Timedelta(aggregation_time).value for aggregation_time
+                                in streaming_energy_parameters["aggregation_count_thresholds"])
+        window_ends = np.concatenate([energy_dataframe.index.values.astype("datetime64[ns]").astype(np.int64)
+                                      for energy_dataframe in energy_dataframe_list])
+        energy_repair_days.setdefault(user_id, set()).update(
+            get_days_of_time_range(int(window_ends.min()) - max_window_length, int(window_ends.max()) - 1))
+        return False
+
+    return True
+
+
+# --------------------- DAYS TO RECOMPUTE BY THE DAILY JOB --------------------- #
+
+
+def get_days_of_time_range(first_timestamp: int, last_timestamp: int) -> List[str]:
+    """
+    :param first_timestamp: nanoseconds since epoch
+    :param last_timestamp: nanoseconds since epoch
+    :return day_list: UTC days overlapping the time range, ex : ["2018-12-07", "2018-12-08"]
+    """
+    day_range = pd.date_range(pd.to_datetime(first_timestamp, unit="ns").normalize(),
+                              pd.to_datetime(last_timestamp, unit="ns").normalize(), freq="D")
+    return [day.strftime("%Y-%m-%d") for day in day_range]
+
+
+def load_energy_repair_days(repair_path: str) -> dict:
+    """
+    Load the days whose energy has to be recomputed by the daily job.
+    :param repair_path: path of the JSON file
+    :return energy_repair_days: sorted list of days by user, ex : {"user_1": ["2018-12-07"]}
+    """
+    try:
+        with open(repair_path) as repair_file:
+            return json.load(repair_file)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _update_energy_repair_days(repair_path: str, update_function):
+    repair_directory = os.path.dirname(repair_path)
+    if repair_directory and not os.path.exists(repair_directory):
+        os.makedirs(repair_directory)
+
+    # The raw data and energy DAGs both update the file
+    with open(repair_path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        energy_repair_days = load_energy_repair_days(repair_path)
+        update_function(energy_repair_days)
+        temporary_path = repair_path + ".tmp"
+        with open(temporary_path, "w") as repair_file:
+            json.dump({user_id: days for user_id, days in energy_repair_days.items() if days}, repair_file)
+        os.replace(temporary_path, repair_path)
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def add_energy_repair_days(repair_path: str, energy_repair_days: dict):
+    """
+    Add days whose energy has to be recomputed by the daily job.
+    :param repair_path: path of the JSON file
+    :param energy_repair_days: days to add by user
+    """
+    def add_days(saved_energy_repair_days):
+        for user_id, days in energy_repair_days.items():
+            saved_energy_repair_days[user_id] = sorted(set(saved_energy_repair_days.get(user_id, [])) | set(days))
+
+    _update_energy_repair_days(repair_path, add_days)
+
+
+def remove_energy_repair_days(repair_path: str, user_id: str, days: List[str]):
+    """
+    Remove days of a user once their energy has been recomputed.
+    :param repair_path: path of the JSON file
+    :param user_id:
+    :param days: recomputed days
+    """
+    def remove_days(saved_energy_repair_days):
+        saved_energy_repair_days[user_id] = sorted(set(saved_energy_repair_days.get(user_id, [])) - set(days))
+
+    _update_energy_repair_days(repair_path, remove_days)
 
 
 if __name__ == "__main__":
@@ -236,6 +853,15 @@ if __name__ == "__main__":
     ONE_MIN_THRESHOLD = motion_acm_constants["one_min_threshold"]
     MAX_SUCCESSIVE_TIME_DIFF = motion_acm_constants["max_successive_time_diff"]
 
+    # MotionGyroscope and RrInterval useful
+    motion_gyro_constants = config["Motion Gyroscope"]
+    rr_interval_constants = config["RR Interval"]
+    FEATURE_DEFINITIONS = create_feature_definitions(FIVE_SEC_THRESHOLD, ONE_MIN_THRESHOLD, MAX_SUCCESSIVE_TIME_DIFF,
+                                                     motion_gyro_constants["five_sec_threshold"],
+                                                     motion_gyro_constants["one_min_threshold"],
+                                                     rr_interval_constants["hrv_aggregation_time"],
+                                                     rr_interval_constants["hrv_count_threshold"])
+
     # see InfluxDB Python API for more information
     # https://influxdb-python.readthedocs.io/en/latest/api-documentation.html
     CLIENT = InfluxDBClient(host=HOST, port=PORT, username=USER, password=PASSWORD, database=DB_NAME)
@@ -245,6 +871,4 @@ if __name__ == "__main__":
     user_list = get_user_list(CLIENT)
 
     for user_id in user_list:
-        create_and_write_energy_for_user(user_id, CLIENT, DF_CLIENT, ACCELEROMETER_MEASUREMENT_NAME,
-                                         FIVE_SEC_THRESHOLD, ONE_MIN_THRESHOLD, MAX_SUCCESSIVE_TIME_DIFF,
-                                         batch_size=5000)
\ No newline at end of file
+        create_and_write_features_for_user(user_id, CLIENT, DF_CLIENT, FEATURE_DEFINITIONS, batch_size=5000)
\ No newline at end of file
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""This script defines methods to read energy data from InfluxDB through a local day cache"""
+
+import os
+import pandas as pd
+from user_catalog_methods import get_catalog_timestamp, load_catalog
+from energy_injector_methods import load_energy_repair_days
+
+ACCELEROMETER_MEASUREMENT_NAME = "MotionAccelerometer"
+REFERENCE_ENERGY_FIELD = "energy_by_5s"
+CACHE_FILE_EXTENSION = ".pkl"
+
+# --------------------- CACHE CREATION --------------------- #
+
+
+def create_energy_query_cache(df_client, cache_directory: str, max_size_bytes: int = 1024 ** 3,
+                              nb_open_days: int = 1, user_catalog_path: str = None,
+                              energy_repair_path: str = None) -> dict:
+    """
+    Create a cache serving energy data of closed days from local files.
+    :param df_client: InfluxDB DataFrameClient used to fetch missing and open days
+    :param cache_directory: directory where day partitions are stored
+    :param max_size_bytes: size of the cache above which least recently used partitions are removed
+    :param nb_open_days: number of days, including the current one, that are still receiving data
+    and are always fetched live
+    :param user_catalog_path: path of the user catalog. A day is only closed once the energy job has
+    written energy after its end. Without catalog, days older than nb_open_days are closed but
+    empty results are never cached.
+    :param energy_repair_path: path of the days whose energy is recomputed by the daily job. These days
+    are open until they are recomputed and their cached partitions are removed.
+    :return energy_query_cache:
+    """
+    if not os.path.exists(cache_directory):
+        os.makedirs(cache_directory)
+    return {"df_client": df_client,
+            "cache_directory": cache_directory,
+            "max_size_bytes": max_size_bytes,
+            "nb_open_days": nb_open_days,
+            "user_catalog_path": user_catalog_path,
+            "energy_repair_path": energy_repair_path,
+            "statistics": {"hits": 0, "misses": 0, "live_queries": 0, "evictions": 0}}
+
+
+def get_energy_query_cache_statistics(energy_query_cache: dict) -> dict:
+    """
+    Get the hit, miss, live query and eviction counters of the cache.
+    :param energy_query_cache:
+    :return statistics:
+    """
+    return dict(energy_query_cache["statistics"])
+
+
+# --------------------- DAY PARTITIONS --------------------- #
+
+
+def _to_utc_timestamp(timestamp) -> pd.Timestamp:
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is None:
+        return timestamp.tz_localize("UTC")
+    return timestamp.tz_convert("UTC")
+
+
+def get_day_partition_path(energy_query_cache: dict, user_id: str, field: str, day: pd.Timestamp) -> str:
+    """
+    :param energy_query_cache:
+    :param user_id:
+    :param field:
+    :param day:
+    :return partition_path: path of the file storing a day of a field for a user
+    """
+    return os.path.join(energy_query_cache["cache_directory"], user_id, field,
+                        day.strftime("%Y-%m-%d") + CACHE_FILE_EXTENSION)
+
+
+def query_day_from_influxdb(energy_query_cache: dict, user_id: str, field: str, day: pd.Timestamp) -> pd.DataFrame:
+    """
+    Query a day of an energy field for a user from InfluxDB.
+    :param energy_query_cache:
+    :param user_id:
+    :param field:
+    :param day: UTC midnight of the day to query
+    :return day_dataframe: possibly empty dataframe indexed by time
+    """
+    query = "SELECT \"{}\" FROM {} WHERE \"user\" = '{}' AND time >= '{}' AND time < '{}'".format(
+        field, ACCELEROMETER_MEASUREMENT_NAME, user_id,
+        day.strftime("%Y-%m-%dT%H:%M:%SZ"), (day + pd.Timedelta("1D")).strftime("%Y-%m-%dT%H:%M:%SZ"))
+    query_result = energy_query_cache["df_client"].query(query)
+    if ACCELEROMETER_MEASUREMENT_NAME in query_result:
+        return query_result[ACCELEROMETER_MEASUREMENT_NAME]
+    return pd.DataFrame(columns=[field], index=pd.DatetimeIndex([], tz="UTC"))
+
+
+def write_day_partition(energy_query_cache: dict, partition_path: str, day_dataframe: pd.DataFrame):
+    """
+    Atomically write a closed day partition and evict least recently used partitions if the cache
+    is too large.
+    :param energy_query_cache:
+    :param partition_path:
+    :param day_dataframe:
+    """
+    partition_directory = os.path.dirname(partition_path)
+    if not os.path.exists(partition_directory):
+        os.makedirs(partition_directory)
+    temporary_path = partition_path + ".tmp"
+    day_dataframe.to_pickle(temporary_path)
+    os.replace(temporary_path, partition_path)
+    evict_least_recently_used_partitions(energy_query_cache)
+
+
+def evict_least_recently_used_partitions(energy_query_cache: dict):
+    """
+    Remove the least recently used day partitions until the cache fits in max_size_bytes.
+    The modification time of a partition is updated each time it is read.
+    :param energy_query_cache:
+    """
+    partition_list = []
+    for directory, _, file_names in os.walk(energy_query_cache["cache_directory"]):
+        for file_name in file_names:
+            if file_name.endswith(CACHE_FILE_EXTENSION):
+                partition_path = os.path.join(directory, file_name)
+                partition_stat = os.stat(partition_path)
+                partition_list.append((partition_stat.st_mtime, partition_stat.st_size, partition_path))
+
+    cache_size = sum(partition_size for _, partition_size, _ in partition_list)
+    for _, partition_size, partition_path in sorted(partition_list):
+        if cache_size <= energy_query_cache["max_size_bytes"]:
+            break
+        os.remove(partition_path)
+        cache_size -= partition_size
+        energy_query_cache["statistics"]["evictions"] += 1
+
+
+def remove_day_partitions(energy_query_cache: dict, user_id: str, day: pd.Timestamp):
+    """
+    Remove the cached partitions of every field of a user for a day.
+    :param energy_query_cache:
+    :param user_id:
+    :param day: UTC midnight of the day
+    """
+    user_directory = os.path.join(energy_query_cache["cache_directory"], user_id)
+    if not os.path.isdir(user_directory):
+        return
+    for field in os.listdir(user_directory):
+        partition_path = get_day_partition_path(energy_query_cache, user_id, field, day)
+        if os.path.exists(partition_path):
+            os.remove(partition_path)
+
+
+def is_day_closed(energy_query_cache: dict, user_id: str, day: pd.Timestamp, user_catalog: dict = None,
+                  repair_days: set = None) -> bool:
+    """
+    Check whether the energy of a day can not change anymore and can be cached.
+    :param energy_query_cache:
+    :param user_id:
+    :param day: UTC midnight of the day
+    :param user_catalog: user catalog giving the last energy timestamp written by the energy job
+    :param repair_days: days of the user whose energy is still to be recomputed by the daily job
+    :return is_closed (Boolean):
+    """
+    if repair_days and day.strftime("%Y-%m-%d") in repair_days:
+        return False
+    current_day = pd.Timestamp.now(tz="UTC").normalize()
+    first_open_day = current_day - pd.Timedelta(days=energy_query_cache["nb_open_days"] - 1)
+    if day >= first_open_day:
+        return False
+    if user_catalog is None:
+        return True
+
+    last_energy_timestamp = get_catalog_timestamp(user_catalog, user_id, ACCELEROMETER_MEASUREMENT_NAME,
+                                                  REFERENCE_ENERGY_FIELD, "last")
+    return last_energy_timestamp is not None and last_energy_timestamp >= (day + pd.Timedelta("1D")).value
+
+
+def get_day_dataframe(energy_query_cache: dict, user_id: str, field: str, day: pd.Timestamp,
+                      user_catalog: dict = None, repair_days: set = None) -> pd.DataFrame:
+    """
+    Get a day of an energy field for a user, from the cache if the day is closed.
+    :param energy_query_cache:
+    :param user_id:
+    :param field:
+    :param day: UTC midnight of the day
+    :param user_catalog: user catalog used to know whether the day is closed
+    :param repair_days: days of the user whose energy is still to be recomputed by the daily job
+    :return day_dataframe:
+    """
+    if not is_day_closed(energy_query_cache, user_id, day, user_catalog, repair_days):
+        # Late samples may have reopened a day that was already cached
+        if repair_days and day.strftime("%Y-%m-%d") in repair_days:
+            remove_day_partitions(energy_query_cache, user_id, day)
+        energy_query_cache["statistics"]["live_queries"] += 1
+        return query_day_from_influxdb(energy_query_cache, user_id, field, day)
+
+    partition_path = get_day_partition_path(energy_query_cache, user_id, field, day)
+    try:
+        day_dataframe = pd.read_pickle(partition_path)
+        os.utime(partition_path)
+        energy_query_cache["statistics"]["hits"] += 1
+        return day_dataframe
+    except (OSError, ValueError, EOFError):
+        pass
+
+    energy_query_cache["statistics"]["misses"] += 1
+    day_dataframe = query_day_from_influxdb(energy_query_cache, user_id, field, day)
+    # Without catalog, an empty day may be a day whose energy is not computed yet
+    if user_catalog is not None or not day_dataframe.empty:
+        write_day_partition(energy_query_cache, partition_path, day_dataframe)
+    return day_dataframe
+
+
+# --------------------- ENERGY QUERIES --------------------- #
+
+
+def get_energy_for_user(energy_query_cache: dict, user_id: str, start_time, end_time,
+                        field: str = "energy_by_5s") -> pd.DataFrame:
+    """
+    Get the energy of a user between two timestamps. Closed days are read from the cache and
+    only open days are queried from InfluxDB. The user catalog and the energy repair days are
+    read once per call.
+    :param energy_query_cache: cache created by create_energy_query_cache
+    :param user_id:
+    :param start_time: start of the range, naive timestamps are considered UTC
+    :param end_time: end of the range (excluded), naive timestamps are considered UTC
+    :param field: energy field, ex : "energy_by_5s" or "energy_by_1min"
+    :return energy_dataframe: dataframe indexed by UTC time
+    """
+    start_time, end_time = _to_utc_timestamp(start_time), _to_utc_timestamp(end_time)
+    day_list = pd.date_range(start_time.normalize(), end_time, freq="D", tz="UTC")
+    user_catalog = None
+    if energy_query_cache["user_catalog_path"] is not None:
+        user_catalog = load_catalog(energy_query_cache["user_catalog_path"])
+
+    repair_days = set()
+    if energy_query_cache["energy_repair_path"] is not None:
+        repair_days = set(load_energy_repair_days(energy_query_cache["energy_repair_path"]).get(user_id, []))
+
+    day_dataframe_list = [get_day_dataframe(energy_query_cache, user_id, field, day, user_catalog, repair_days)
+                          for day in day_list if day < end_time]
+    if not day_dataframe_list:
+        return pd.DataFrame(columns=[field], index=pd.DatetimeIndex([], tz="UTC"))
+
+    energy_dataframe = pd.concat(day_dataframe_list).sort_index()
+    return energy_dataframe[(energy_dataframe.index >= start_time) & (energy_dataframe.index < end_time)]
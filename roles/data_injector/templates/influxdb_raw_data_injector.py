@@ -8,16 +8,172 @@ import os
 import glob
 import configparser
 import json
+import mmap
+import re
+import time
+import tempfile
+import warnings
 from influxdb import InfluxDBClient
 from influxdb import DataFrameClient
 import pandas as pd
 import numpy as np
 import math
+from user_catalog_methods import load_catalog, save_catalog, update_catalog_with_dataframe
+from energy_injector_methods import (add_energy_repair_days, compute_and_write_streaming_energy,
+                                     load_streaming_energy_state, save_streaming_energy_state)
+
+# orjson is used to parse JSON files when it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # JSON field values
 TYPE_PARAM_NAME = "type"
 USER_PARAM_NAME = "user"
 DEVICE_PARAM_NAME = "device_address"
+METADATA_PARAM_NAMES = [TYPE_PARAM_NAME, USER_PARAM_NAME, DEVICE_PARAM_NAME]
+
+# Number of bytes read at the beginning and at the end of a file to find its metadata
+METADATA_READ_SIZE = 4096
+
+# Files larger than this size are memory-mapped and their data are read by blocks of records
+LARGE_FILE_SIZE_BYTES = 50 * 1024 ** 2
+DATA_BLOCK_SIZE = 100000
+DATA_ARRAY_PATTERN = re.compile(b'"data"\\s*:\\s*\\[')
+DATA_RECORD_PATTERN = re.compile(b'"([^"]*)"')
+METADATA_PATTERNS = {param_name: re.compile(b'"' + param_name.encode() + b'"\\s*:\\s*"([^"]*)"')
+                     for param_name in METADATA_PARAM_NAMES}
+
+# Timestamp layout sent by the mobile app, ex : "2018-12-07T12:30:00.123"
+MOBILE_APP_TIMESTAMP_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{1,9})?$")
+
+# ---------------- JSON FILES READING ---------------- #
+
+
+def load_json_file(file_path):
+    """
+    Function parsing a JSON file, with orjson if it is installed and the json module otherwise
+    Arguments
+    ---------
+    file_path - path of the JSON file
+    Returns
+    ---------
+    json_data - parsed JSON content
+    """
+    with open(file_path, "rb") as json_file:
+        json_content = json_file.read()
+    if orjson is not None:
+        return orjson.loads(json_content)
+    return json.loads(json_content.decode("utf-8"))
+
+
+def read_json_file_metadata(file_path, large_file_size_bytes=LARGE_FILE_SIZE_BYTES) -> dict:
+    """
+    Function extracting the type, user and device address of a JSON file. Only the beginning and
+    the end of the file are read. If metadata are not found there, the whole file is parsed, or
+    searched through a memory map for files larger than large_file_size_bytes.
+    Arguments
+    ---------
+    file_path - path of the JSON file
+    large_file_size_bytes - size from which the file is never parsed as a whole
+    Returns
+    ---------
+    metadata - dictionary with type, user and device_address values
+    """
+    with open(file_path, "rb") as json_file:
+        head = json_file.read(METADATA_READ_SIZE)
+        json_file.seek(0, os.SEEK_END)
+        file_size = json_file.tell()
+        tail = b""
+        if file_size > METADATA_READ_SIZE:
+            json_file.seek(max(METADATA_READ_SIZE, file_size - METADATA_READ_SIZE))
+            tail = json_file.read()
+
+    metadata = dict()
+    for param_name in METADATA_PARAM_NAMES:
+        match = METADATA_PATTERNS[param_name].search(head) or METADATA_PATTERNS[param_name].search(tail)
+        if match is None:
+            break
+        metadata[param_name] = match.group(1).decode("utf-8")
+    else:
+        return metadata
+
+    # Metadata are in the middle of a large file, memory stays bounded
+    if file_size > large_file_size_bytes:
+        with open(file_path, "rb") as json_file:
+            with mmap.mmap(json_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                for param_name in METADATA_PARAM_NAMES:
+                    match = METADATA_PATTERNS[param_name].search(mapped_file)
+                    if match is None:
+                        raise ValueError("No {} in file {}".format(param_name, file_path))
+                    metadata[param_name] = match.group(1).decode("utf-8")
+        return metadata
+
+    # Metadata are in the middle of the file
+    json_data = load_json_file(file_path)
+    return {param_name: json_data[param_name] for param_name in METADATA_PARAM_NAMES}
+
+
+def iterate_json_data_blocks(file_path, block_size=DATA_BLOCK_SIZE):
+    """
+    Generator reading the "data" array of a JSON file by blocks of records. The file is
+    memory-mapped and records are decoded one block at a time, so memory stays bounded
+    whatever the file size. A ValueError is raised if the data array is missing or not closed.
+    Arguments
+    ---------
+    file_path - path of the JSON file
+    block_size - number of records in each block
+    Returns
+    ---------
+    block - list of at most block_size data records, ex : ["2018-12-07T12:30:00.000 1 2 3", ...]
+    """
+    with open(file_path, "rb") as json_file:
+        with mmap.mmap(json_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            data_array_match = DATA_ARRAY_PATTERN.search(mapped_file)
+            if data_array_match is None:
+                raise ValueError("No data array in file {}".format(file_path))
+            data_array_end = mapped_file.find(b"]", data_array_match.end())
+            if data_array_end == -1:
+                raise ValueError("Data array not closed in file {}, upload may be truncated".format(file_path))
+
+            block = []
+            for record_match in DATA_RECORD_PATTERN.finditer(mapped_file, data_array_match.end(), data_array_end):
+                block.append(record_match.group(1).decode("utf-8"))
+                if len(block) == block_size:
+                    yield block
+                    block = []
+            if block:
+                yield block
+
+
+# ---------------- TIMESTAMP PARSING ---------------- #
+
+
+def parse_timestamp_index(timestamp_index: pd.Index) -> pd.DatetimeIndex:
+    """
+    Function converting an index of timestamp strings to a DatetimeIndex. When the first timestamp
+    follows the layout of the mobile app, all timestamps are converted at once by numpy without
+    format inference. pd.to_datetime is used for any other layout, or if numpy can not convert
+    a timestamp or warns about a time zone.
+    Arguments
+    ---------
+    timestamp_index - index of timestamp strings
+    Returns
+    ---------
+    datetime_index - resulting DatetimeIndex
+    """
+    timestamps = timestamp_index.values
+    if len(timestamps) and isinstance(timestamps[0], str) and MOBILE_APP_TIMESTAMP_PATTERN.match(timestamps[0]):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("error")
+                return pd.DatetimeIndex(np.asarray(timestamps, dtype=object).astype("datetime64[ns]"),
+                                        name=timestamp_index.name)
+        except (ValueError, TypeError, Warning):
+            pass
+    return pd.to_datetime(timestamp_index)
+
 
 # ---------------- JSON TO DATAFRAME CONVERSION ---------------- #
 
@@ -41,7 +197,7 @@ def convert_acm_json_to_df(acm_json):
     # Convert string to numeric values
     df_to_write[["x_acm", "y_acm", "z_acm"]] = df_to_write[["x_acm", "y_acm", "z_acm"]].apply(pd.to_numeric)
     # Convert index to datetime index
-    df_to_write.index = pd.to_datetime(df_to_write.index)
+    df_to_write.index = parse_timestamp_index(df_to_write.index)
     return df_to_write
 
 
@@ -64,7 +220,7 @@ def convert_rri_json_to_df(rri_json):
     # Convert string to numeric values
     df_to_write["RrInterval"] = df_to_write["RrInterval"].apply(pd.to_numeric)
     # Convert index to datetime index
-    df_to_write.index = pd.to_datetime(df_to_write.index)
+    df_to_write.index = parse_timestamp_index(df_to_write.index)
     return df_to_write
 
 
@@ -87,7 +243,7 @@ def convert_gyro_json_to_df(gyro_json):
     # Convert string to numeric values
     df_to_write[["x_gyro", "y_gyro", "z_gyro"]] = df_to_write[["x_gyro", "y_gyro", "z_gyro"]].apply(pd.to_numeric)
     # Convert index to datetime index
-    df_to_write.index = pd.to_datetime(df_to_write.index)
+    df_to_write.index = parse_timestamp_index(df_to_write.index)
     return df_to_write
 
 
@@ -115,32 +271,28 @@ def create_df_with_unique_index(data_to_write):
     return data_to_write
 
 
-def write_file_to_influxdb(file, path_to_data_test_directory, df_client):
+def read_file_to_dataframe(file, path_to_data_test_directory):
     """
-    Function writing JSON file to influxDB
+    Function reading a gyroscope or accelerometer JSON file into a pandas Dataframe
     Arguments
     ---------
-    file - JSON file to convert and write to InfluxDB
+    file - JSON file to convert
     path_to_data_test_directory - path for reading the JSON file
-    get_tmstp - Option to extract all the timestamps of the JSON file
     Returns
     ---------
-    write_success (Boolean) - Result of the write process
+    measurement, tags, data_to_write - measurement, tags and Dataframe to write in influxDB,
+    or None if the file can not be read or converted
     """
-    write_success = True
-
     # Open Json file
     try:
-        with open(path_to_data_test_directory + file) as json_file:
-            json_data = json.load(json_file)
+        json_data = load_json_file(path_to_data_test_directory + file)
         # Get tags from file
         measurement = json_data[TYPE_PARAM_NAME]
         tags = {USER_PARAM_NAME: json_data[USER_PARAM_NAME],
                 DEVICE_PARAM_NAME: json_data[DEVICE_PARAM_NAME]}
     except:
         print("Impossible to open file.")
-        write_success = False
-        return write_success
+        return None
 
     try:
         # Convert json to pandas Dataframe
@@ -150,24 +302,207 @@ def write_file_to_influxdb(file, path_to_data_test_directory, df_client):
             data_to_write = convert_gyro_json_to_df(json_data)
     except:
         print("Impossible to convert file to Dataframe.")
-        write_success = False
-        return write_success
+        return None
 
     # Checking if index of data is unique to avoid overwritten points in InfluxDB
     is_index_unique = data_to_write.index.is_unique
     if not is_index_unique:
         data_to_write = create_df_with_unique_index(data_to_write)
 
+    return measurement, tags, data_to_write
+
+
+def write_dataframe_to_influxdb(data_to_write, measurement, tags, df_client, user_catalog=None,
+                                streaming_energy_state=None, streaming_energy_parameters=None,
+                                batch_size=5000, energy_repair_days=None):
+    """
+    Function writing a Dataframe of raw data to influxDB
+    Arguments
+    ---------
+    data_to_write - Dataframe to write in influxDB
+    measurement - measurement to write to
+    tags - tags of the points
+    df_client - Dataframe InfluxDB Client
+    user_catalog - Optional user catalog updated with the written timestamps
+    streaming_energy_state - Optional per-user state to compute energy of MotionAccelerometer data
+    at ingestion time
+    streaming_energy_parameters - Parameters of the energy computed at ingestion time
+    batch_size - number of points sent in each HTTP request
+    energy_repair_days - Days to recompute by user, filled when energy can not be computed at
+    ingestion time
+    Returns
+    ---------
+    write_success (Boolean) - Result of the write process
+    """
+    write_success = True
+
     # write to InfluxDB
     try:
-        df_client.write_points(data_to_write, measurement=measurement, tags=tags, protocol="json")
+        df_client.write_points(data_to_write, measurement=measurement, tags=tags, protocol="json",
+                               batch_size=batch_size)
     except:
         print("Impossible to write file to influxDB")
         write_success = False
 
+    if write_success and user_catalog is not None:
+        update_catalog_with_dataframe(user_catalog, measurement, tags, data_to_write)
+
+    # Compute energy of closed windows from the written samples. Raw data are written, so days whose
+    # energy fails are recomputed by the daily job instead of marking the file as failed.
+    if write_success and streaming_energy_state is not None and measurement == "MotionAccelerometer":
+        compute_and_write_streaming_energy(data_to_write, tags[USER_PARAM_NAME], df_client,
+                                           streaming_energy_state, streaming_energy_parameters,
+                                           energy_repair_days, user_catalog)
+
     return write_success
 
 
+def write_file_to_influxdb(file, path_to_data_test_directory, df_client, user_catalog=None,
+                           streaming_energy_state=None, streaming_energy_parameters=None,
+                           energy_repair_days=None):
+    """
+    Function writing JSON file to influxDB
+    Arguments
+    ---------
+    file - JSON file to convert and write to InfluxDB
+    path_to_data_test_directory - path for reading the JSON file
+    df_client - Dataframe InfluxDB Client
+    user_catalog - Optional user catalog updated with the written timestamps
+    streaming_energy_state - Optional per-user state to compute energy of MotionAccelerometer files
+    at ingestion time
+    streaming_energy_parameters - Parameters of the energy computed at ingestion time
+    energy_repair_days - Days to recompute by user, filled when energy can not be computed at
+    ingestion time
+    Returns
+    ---------
+    write_success (Boolean) - Result of the write process
+    """
+    file_content = read_file_to_dataframe(file, path_to_data_test_directory)
+    if file_content is None:
+        return False
+
+    measurement, tags, data_to_write = file_content
+    return write_dataframe_to_influxdb(data_to_write, measurement, tags, df_client, user_catalog,
+                                       streaming_energy_state, streaming_energy_parameters,
+                                       energy_repair_days=energy_repair_days)
+
+
+def write_large_file_to_influxdb(file, path_to_data_test_directory, df_client, user_catalog=None,
+                                 streaming_energy_state=None, streaming_energy_parameters=None,
+                                 block_size=DATA_BLOCK_SIZE, energy_repair_days=None):
+    """
+    Function writing a large gyroscope or accelerometer JSON file to influxDB block by block
+    Arguments
+    ---------
+    file - JSON file to convert and write to InfluxDB
+    path_to_data_test_directory - path for reading the JSON file
+    df_client - Dataframe InfluxDB Client
+    user_catalog - Optional user catalog updated with the written timestamps
+    streaming_energy_state - Optional per-user state to compute energy of MotionAccelerometer files
+    at ingestion time
+    streaming_energy_parameters - Parameters of the energy computed at ingestion time
+    block_size - number of records converted and written at once
+    energy_repair_days - Days to recompute by user, filled when energy can not be computed at
+    ingestion time
+    Returns
+    ---------
+    write_success (Boolean) - Result of the write process
+    """
+    file_path = path_to_data_test_directory + file
+    try:
+        # The file is read by blocks, metadata are searched without parsing it as a whole
+        metadata = read_json_file_metadata(file_path, large_file_size_bytes=0)
+        measurement = metadata[TYPE_PARAM_NAME]
+        tags = {USER_PARAM_NAME: metadata[USER_PARAM_NAME],
+                DEVICE_PARAM_NAME: metadata[DEVICE_PARAM_NAME]}
+        if measurement == "MotionAccelerometer":
+            convert_json_to_df = convert_acm_json_to_df
+        else:
+            convert_json_to_df = convert_gyro_json_to_df
+
+        nb_records = 0
+        for block in iterate_json_data_blocks(file_path, block_size):
+            nb_records += len(block)
+            data_to_write = convert_json_to_df({"data": block})
+            if not data_to_write.index.is_unique:
+                data_to_write = create_df_with_unique_index(data_to_write)
+            if not write_dataframe_to_influxdb(data_to_write, measurement, tags, df_client, user_catalog,
+                                               streaming_energy_state, streaming_energy_parameters,
+                                               energy_repair_days=energy_repair_days):
+                return False
+    except:
+        print("Impossible to read large file by blocks.")
+        return False
+
+    if nb_records == 0:
+        print("No data record in large file.")
+        return False
+    return True
+
+
+# ---------------- WRITE BUFFER ---------------- #
+
+
+def create_write_buffer(max_batch_points=50000, max_batch_age_seconds=300) -> dict:
+    """
+    Create a buffer coalescing the Dataframes of many files sharing the same measurement and tags
+    into large batches, to send fewer and larger time-sorted writes to influxDB.
+    Arguments
+    ---------
+    max_batch_points - number of points from which a batch is written
+    max_batch_age_seconds - age in seconds from which a batch is written
+    Returns
+    ---------
+    write_buffer - empty write buffer
+    """
+    return {"max_batch_points": max_batch_points,
+            "max_batch_age_seconds": max_batch_age_seconds,
+            "batches": dict()}
+
+
+def add_dataframe_to_write_buffer(write_buffer: dict, file, measurement, tags: dict, data_to_write):
+    """
+    Add the Dataframe of a file to the batch of its measurement and tags.
+    Arguments
+    ---------
+    write_buffer - write buffer updated in place
+    file - JSON file the Dataframe comes from
+    measurement - measurement to write to
+    tags - tags of the points
+    data_to_write - Dataframe to write in influxDB
+    """
+    batch_key = (measurement, tuple(sorted(tags.items())))
+    if batch_key not in write_buffer["batches"]:
+        write_buffer["batches"][batch_key] = {"measurement": measurement, "tags": tags, "files": [],
+                                              "dataframes": [], "nb_points": 0, "created_at": time.time()}
+    batch = write_buffer["batches"][batch_key]
+    batch["files"].append(file)
+    batch["dataframes"].append(data_to_write)
+    batch["nb_points"] += len(data_to_write)
+
+
+def pop_batches_to_write(write_buffer: dict, flush_all=False) -> list:
+    """
+    Remove from the buffer the batches that are large or old enough to be written.
+    Arguments
+    ---------
+    write_buffer - write buffer updated in place
+    flush_all - Option to remove all batches, whatever their size and age
+    Returns
+    ---------
+    batches_to_write - list of batches whose Dataframes are concatenated and sorted by time
+    """
+    current_time = time.time()
+    batches_to_write = []
+    for batch_key, batch in list(write_buffer["batches"].items()):
+        if (flush_all or batch["nb_points"] >= write_buffer["max_batch_points"]
+                or current_time - batch["created_at"] >= write_buffer["max_batch_age_seconds"]):
+            del write_buffer["batches"][batch_key]
+            batch["data_to_write"] = pd.concat(batch.pop("dataframes")).sort_index()
+            batches_to_write.append(batch)
+    return batches_to_write
+
+
 def move_processed_file(file, write_success, path_to_read_directory, path_for_written_files,
                         path_for_problem_files):
     """
@@ -212,6 +547,75 @@ def test_influxdb(df_client, nb_points):
         df_client.write_points(data_to_write, measurement=measurement, tags=tags, protocol="json")
 
 
+def benchmark_rri_files_reading(nb_files=5000, nb_points=60, nb_users=10):
+    """
+    Function comparing the time needed to read a directory of small RR-interval files with
+    json.load and a second parse per user for the tags, and with the metadata-first reader
+    Arguments
+    ---------
+    nb_files - number of JSON files to generate
+    nb_points - number of RR-intervals per file
+    nb_users - number of distinct users
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        start_date = datetime.datetime(2018, 8, 10)
+        for i in range(nb_files):
+            user = "user{}".format(i % nb_users)
+            first_date = start_date + datetime.timedelta(minutes=i)
+            json_data = {TYPE_PARAM_NAME: "RrInterval", USER_PARAM_NAME: user, DEVICE_PARAM_NAME: "polar",
+                         "data": ["{} {}".format((first_date + datetime.timedelta(seconds=j)).isoformat(),
+                                                 np.random.randint(500, 1000))
+                                  for j in range(nb_points)]}
+            with open(os.path.join(directory, "{}_RrInterval_{:06d}.json".format(user, i)), "w") as json_file:
+                json.dump(json_data, json_file)
+        files_list = sorted(glob.glob(os.path.join(directory, "*RrInterval*")))
+
+        start = time.time()
+        for user, user_files in create_files_by_user_dict(files_list).items():
+            dataframe_list = []
+            for file in user_files:
+                with open(file) as json_file:
+                    dataframe_list.append(convert_rri_json_to_df(json.load(json_file)))
+            pd.concat(dataframe_list)
+            with open(user_files[0]) as json_file:
+                json_data = json.load(json_file)
+        json_load_duration = time.time() - start
+
+        start = time.time()
+        files_by_user_dict, _ = create_files_by_user_dict_from_metadata(files_list, "RrInterval")
+        for user, user_entry in files_by_user_dict.items():
+            concat_files_into_dataframe(user_entry["files"])
+        metadata_first_duration = time.time() - start
+
+    print("{} files read with json.load in {:.2f}s".format(nb_files, json_load_duration))
+    print("{} files read with metadata-first reader ({}) in {:.2f}s".format(
+        nb_files, "orjson" if orjson is not None else "json", metadata_first_duration))
+
+
+def benchmark_timestamp_parsing(nb_timestamps=1000000):
+    """
+    Function comparing the time needed to convert accelerometer timestamps with pd.to_datetime
+    format inference and with the numpy conversion of the mobile app layout
+    Arguments
+    ---------
+    nb_timestamps - number of timestamps to convert
+    """
+    dates = pd.date_range("2018-12-07 12:30:00", periods=nb_timestamps, freq="20ms")
+    timestamp_index = pd.Index(pd.Index(dates.strftime("%Y-%m-%dT%H:%M:%S.%f")).str[:-3], name="timestamp")
+
+    start = time.time()
+    datetime_index = pd.to_datetime(timestamp_index)
+    to_datetime_duration = time.time() - start
+
+    start = time.time()
+    numpy_datetime_index = parse_timestamp_index(timestamp_index)
+    numpy_duration = time.time() - start
+
+    print("{} timestamps converted with format inference in {:.2f}s".format(nb_timestamps, to_datetime_duration))
+    print("{} timestamps converted with numpy in {:.2f}s, same result : {}".format(
+        nb_timestamps, numpy_duration, datetime_index.equals(numpy_datetime_index)))
+
+
 def create_files_by_user_dict(files_list: list) -> dict:
     """
     Create a dictionary containing the corresponding list of RR-inteval files for each user.
@@ -253,35 +657,79 @@ def create_files_by_user_dict(files_list: list) -> dict:
     return files_by_user_dict
 
 
-def concat_files_into_dataframe(files_list: list) -> pd.DataFrame:
+def concat_files_into_dataframe(files_list: list, large_file_size_bytes=LARGE_FILE_SIZE_BYTES,
+                                block_size=DATA_BLOCK_SIZE) -> pd.DataFrame:
     """
-    Concatenate JSON files content into a single pandas DataFrame.
+    Concatenate RR-interval JSON files content into a single pandas DataFrame.
     Arguments
     ---------
-    files_list - list of files to sort
+    files_list - list of RR-interval files, already filtered by create_files_by_user_dict_from_metadata
+    large_file_size_bytes - size from which a file is read by blocks of records
+    block_size - number of records in each block
     Returns
     ---------
     concatened_dataframe - resulting pandas DataFrame
     """
     dataframe_list = []
     for file in files_list:
-        # Open Json file
-        with open(file) as json_file:
-            json_data = json.load(json_file)
-
-        # Get tags from file
-        measurement = json_data[TYPE_PARAM_NAME]
+        # Read large files by blocks without parsing the whole JSON
+        if os.path.getsize(file) > large_file_size_bytes:
+            dataframe_list.extend(convert_rri_json_to_df({"data": block})
+                                  for block in iterate_json_data_blocks(file, block_size))
+            continue
 
         # Extract data and create dataframe from JSON file
-        if measurement == "RrInterval":
-            df = convert_rri_json_to_df(json_data)
-            dataframe_list.append(df)
+        json_data = load_json_file(file)
+        df = convert_rri_json_to_df(json_data)
+        dataframe_list.append(df)
 
     # Concat list of dataframe
     concatened_dataframe = pd.concat(dataframe_list)
     return concatened_dataframe
 
 
+def create_files_by_user_dict_from_metadata(files_list: list, measurement: str,
+                                            large_file_size_bytes=LARGE_FILE_SIZE_BYTES) -> tuple:
+    """
+    Read the metadata of each file once and group files of the given measurement by user.
+    Arguments
+    ---------
+    files_list - list of files to sort
+    measurement - type of the files to keep
+    large_file_size_bytes - size from which a file is never parsed as a whole to read its metadata
+    Returns
+    ---------
+    files_by_user_dict - dictionary containing the list of files and the tags of each user
+    ex :
+    files_by_user_dict = {
+            'user_1': {"files": ["file_1", "file_2"], "tags": {"user": "user_1", "device_address": "xx"}},
+    }
+    unreadable_files_list - list of files whose metadata could not be read
+    """
+    files_by_user_dict = dict()
+    unreadable_files_list = []
+    for file in files_list:
+        try:
+            metadata = read_json_file_metadata(file, large_file_size_bytes)
+        except:
+            print("Impossible to read metadata of file {}".format(file))
+            unreadable_files_list.append(file)
+            continue
+
+        if metadata[TYPE_PARAM_NAME] != measurement:
+            print("File {} is not of type {}".format(file, measurement))
+            continue
+
+        user = metadata[USER_PARAM_NAME]
+        if user not in files_by_user_dict:
+            files_by_user_dict[user] = {"files": [],
+                                        "tags": {USER_PARAM_NAME: user,
+                                                 DEVICE_PARAM_NAME: metadata[DEVICE_PARAM_NAME]}}
+        files_by_user_dict[user]["files"].append(file)
+
+    return files_by_user_dict, unreadable_files_list
+
+
 def create_corrected_timestamp_list(concatenated_df: pd.DataFrame) -> list:
     """
     Create a corrected timestamp based on cumulative sum of RR-intervals values.
@@ -322,7 +770,9 @@ def create_corrected_timestamp_list(concatenated_df: pd.DataFrame) -> list:
 
 
 def execute_rri_files_write_pipeline(path_to_read_directory, path_for_written_files,
-                                     path_for_problems_files, df_client, verbose=False):
+                                     path_for_problems_files, df_client, verbose=False,
+                                     user_catalog_path=None, large_file_size_bytes=LARGE_FILE_SIZE_BYTES,
+                                     block_size=DATA_BLOCK_SIZE):
     """
     Process all files in the read directory to write them to influxDB.
     Arguments
@@ -332,15 +782,22 @@ def execute_rri_files_write_pipeline(path_to_read_directory, path_for_written_fi
     path_for_problems_files - path where we move files for which write proccess failed.
     df_client - Dataframe InfluxDB Client
     verbose - Option to print some logs informations about process.
+    user_catalog_path - Optional path of the user catalog updated with the written timestamps.
+    large_file_size_bytes - size from which a file is read by blocks of records.
+    block_size - number of records in each block.
     """
+    user_catalog = load_catalog(user_catalog_path) if user_catalog_path is not None else None
+
     # files list containing RR-Interval in directory
     rri_files_list = glob.glob(path_to_read_directory + "*RrInterval*")
     rri_files_list.sort()
     if verbose:
         print("There are currently {} files.".format(len(rri_files_list)))
 
-    # group and sort files by user
-    sorted_rri_files_dict = create_files_by_user_dict(rri_files_list)
+    # group and sort files by user, reading metadata once per file
+    sorted_rri_files_dict, unreadable_files_list = create_files_by_user_dict_from_metadata(rri_files_list,
+                                                                                           "RrInterval",
+                                                                                           large_file_size_bytes)
 
     # Creating directory for processed files
     if not os.path.exists(path_for_written_files):
@@ -348,31 +805,28 @@ def execute_rri_files_write_pipeline(path_to_read_directory, path_for_written_fi
     if not os.path.exists(path_for_problems_files):
         os.makedirs(path_for_problems_files)
 
+    for json_file in unreadable_files_list:
+        move_processed_file(json_file.split("/")[-1], False, path_to_read_directory,
+                            path_for_written_files, path_for_problems_files)
+
     for user in sorted_rri_files_dict.keys():
         write_success = True
 
-        user_rri_files = sorted_rri_files_dict[user]
-
-        # concat multiple files of each user
-        concatenated_dataframe = concat_files_into_dataframe(files_list=user_rri_files)
-
-        # Create new timestamp
-        corrected_timestamp_list = create_corrected_timestamp_list(concatenated_dataframe)
-        concatenated_dataframe.index = corrected_timestamp_list
-        concatenated_dataframe.index.names = ["timestamp"]
-
-        # Open Json file
-        try:
-            with open(user_rri_files[0]) as json_file:
-                json_data = json.load(json_file)
-            tags = {USER_PARAM_NAME: json_data[USER_PARAM_NAME],
-                    DEVICE_PARAM_NAME: json_data[DEVICE_PARAM_NAME]}
-        except:
-            print("Impossible to open file.")
-            write_success = False
+        user_rri_files = sorted_rri_files_dict[user]["files"]
+        tags = sorted_rri_files_dict[user]["tags"]
 
         # write to InfluxDB
         try:
+            # concat multiple files of each user
+            concatenated_dataframe = concat_files_into_dataframe(files_list=user_rri_files,
+                                                                 large_file_size_bytes=large_file_size_bytes,
+                                                                 block_size=block_size)
+
+            # Create new timestamp
+            corrected_timestamp_list = create_corrected_timestamp_list(concatenated_dataframe)
+            concatenated_dataframe.index = corrected_timestamp_list
+            concatenated_dataframe.index.names = ["timestamp"]
+
             # Chunk dataframe for time series db performance issues
             chunk_nb = math.ceil(len(concatenated_dataframe) / 5000)
             print("CHUNK NB : {}".format(chunk_nb))
@@ -384,6 +838,9 @@ def execute_rri_files_write_pipeline(path_to_read_directory, path_for_written_fi
             print("Impossible to write file to influxDB")
             write_success = False
 
+        if write_success and user_catalog is not None:
+            update_catalog_with_dataframe(user_catalog, "RrInterval", tags, concatenated_dataframe)
+
         for json_file in user_rri_files:
             move_processed_file(json_file.split("/")[-1], write_success, path_to_read_directory,
                                 path_for_written_files, path_for_problems_files)
@@ -392,9 +849,16 @@ def execute_rri_files_write_pipeline(path_to_read_directory, path_for_written_fi
                 log = "[" + file_processed_timestamp + "]" + " : " + json_file + " processed"
                 print(log)
 
+    if user_catalog is not None:
+        save_catalog(user_catalog, user_catalog_path)
+
 
 def execute_acm_gyro_files_write_pipeline(path_to_read_directory, path_for_written_files,
-                                          path_for_problems_files, df_client, verbose=False):
+                                          path_for_problems_files, df_client, verbose=False,
+                                          user_catalog_path=None, streaming_energy_state_path=None,
+                                          streaming_energy_parameters=None, max_batch_points=50000,
+                                          max_batch_age_seconds=300, large_file_size_bytes=LARGE_FILE_SIZE_BYTES,
+                                          block_size=DATA_BLOCK_SIZE, energy_repair_path=None):
     """
     Process all gyroscope and accelerometer files in the read directory to write them to influxDB.
     Arguments
@@ -404,9 +868,27 @@ def execute_acm_gyro_files_write_pipeline(path_to_read_directory, path_for_writt
     path_for_problems_files - path where we move files for which write proccess failed.
     df_client - Dataframe InfluxDB Client
     verbose - Option to print some logs informations about process.
+    user_catalog_path - Optional path of the user catalog updated with the written timestamps.
+    streaming_energy_state_path - Optional path of the state used to compute energy at ingestion time.
+    streaming_energy_parameters - Parameters of the energy computed at ingestion time.
+    max_batch_points - number of points from which files sharing measurement and tags are written.
+    max_batch_age_seconds - age in seconds from which files sharing measurement and tags are written.
+    large_file_size_bytes - size from which a file is read and written by blocks of records.
+    block_size - number of records in each block.
+    energy_repair_path - path of the days whose energy is recomputed by the daily job, filled with late
+    samples and failed energy writes.
     """
+    user_catalog = load_catalog(user_catalog_path) if user_catalog_path is not None else None
+    energy_repair_days = dict()
+    streaming_energy_state = None
+    if streaming_energy_state_path is not None:
+        streaming_energy_state = load_streaming_energy_state(streaming_energy_state_path)
+
     # List files to process
     list_files = os.listdir(path_to_read_directory)
+    if streaming_energy_state is not None:
+        # Files of a user are named after the user and time, so samples are fed in order
+        list_files.sort()
     if verbose:
         print("There are currently {} files.".format(len(list_files)))
 
@@ -416,17 +898,55 @@ def execute_acm_gyro_files_write_pipeline(path_to_read_directory, path_for_writt
     if not os.path.exists(path_for_problems_files):
         os.makedirs(path_for_problems_files)
 
-    # Processing & writing files to influx and cleaning directory
+    def move_and_log_processed_files(files, is_writen):
+        for json_file in files:
+            move_processed_file(json_file, is_writen, path_to_read_directory, path_for_written_files,
+                                path_for_problems_files)
+
+            if verbose:
+                file_processed_timestamp = str(datetime.datetime.now())
+                log = "[" + file_processed_timestamp + "]" + " : " + json_file + " processed"
+                print(log)
+
+    def write_batches(batches_to_write):
+        for batch in batches_to_write:
+            is_writen = write_dataframe_to_influxdb(batch["data_to_write"], batch["measurement"], batch["tags"],
+                                                    df_client, user_catalog, streaming_energy_state,
+                                                    streaming_energy_parameters,
+                                                    energy_repair_days=energy_repair_days)
+            move_and_log_processed_files(batch["files"], is_writen)
+
+    # Processing files, writing them to influx by batches of same measurement and tags
+    # and cleaning directory
+    write_buffer = create_write_buffer(max_batch_points, max_batch_age_seconds)
     list_files_generator = (file for file in list_files)
     for json_file in list_files_generator:
-        is_writen = write_file_to_influxdb(json_file, path_to_read_directory, df_client)
-        move_processed_file(json_file, is_writen, path_to_read_directory, path_for_written_files,
-                            path_for_problems_files)
-
-        if verbose:
-            file_processed_timestamp = str(datetime.datetime.now())
-            log = "[" + file_processed_timestamp + "]" + " : " + json_file + " processed"
-            print(log)
+        if os.path.getsize(path_to_read_directory + json_file) > large_file_size_bytes:
+            # Buffered files are written first to keep samples of a user in order
+            write_batches(pop_batches_to_write(write_buffer, flush_all=True))
+            is_writen = write_large_file_to_influxdb(json_file, path_to_read_directory, df_client, user_catalog,
+                                                     streaming_energy_state, streaming_energy_parameters,
+                                                     block_size, energy_repair_days)
+            move_and_log_processed_files([json_file], is_writen)
+            continue
+
+        file_content = read_file_to_dataframe(json_file, path_to_read_directory)
+        if file_content is None:
+            move_and_log_processed_files([json_file], False)
+            continue
+
+        measurement, tags, data_to_write = file_content
+        add_dataframe_to_write_buffer(write_buffer, json_file, measurement, tags, data_to_write)
+        write_batches(pop_batches_to_write(write_buffer))
+
+    write_batches(pop_batches_to_write(write_buffer, flush_all=True))
+
+    if user_catalog is not None:
+        save_catalog(user_catalog, user_catalog_path)
+    if streaming_energy_state is not None:
+        save_streaming_energy_state(streaming_energy_state, streaming_energy_state_path)
+    if energy_repair_days and energy_repair_path is not None:
+        add_energy_repair_days(energy_repair_path, energy_repair_days)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""This script defines methods to maintain a local catalog of users, devices and timestamps."""
+
+import os
+import json
+import time
+import fcntl
+from typing import List
+
+# JSON field values
+TYPE_PARAM_NAME = "type"
+USER_PARAM_NAME = "user"
+DEVICE_PARAM_NAME = "device_address"
+
+# Raw fields whose first/last timestamps are tracked when files are ingested. Feature fields are
+# tracked when they are written, whatever their name.
+RAW_CATALOG_FIELDS_BY_MEASUREMENT = {
+    "MotionAccelerometer": ["x_acm"],
+    "MotionGyroscope": ["x_gyro"],
+    "RrInterval": ["RrInterval"],
+}
+
+# ---------------- CATALOG STRUCTURE ---------------- #
+
+
+def create_empty_catalog() -> dict:
+    """
+    Create an empty user catalog.
+    Returns
+    ---------
+    catalog - dictionary with the following structure
+    ex :
+    catalog = {
+        "refreshed_at": 1545066000.0,
+        "users": {
+            'user_1': {
+                "devices": ["device_1"],
+                "timestamps": {
+                    "MotionAccelerometer": {"x_acm": {"first": 1545000000000000000,
+                                                      "last": 1545066000000000000}}
+                }
+            }
+        }
+    }
+    """
+    return {"refreshed_at": 0.0, "users": dict()}
+
+
+def _get_or_create_user_entry(catalog: dict, user: str) -> dict:
+    return catalog["users"].setdefault(user, {"devices": [], "timestamps": dict()})
+
+
+def _update_timestamp_entry(user_entry: dict, measurement: str, field: str,
+                            first_timestamp: int = None, last_timestamp: int = None):
+    field_entry = user_entry["timestamps"].setdefault(measurement, dict()).setdefault(field, dict())
+    if first_timestamp is not None:
+        current_first = field_entry.get("first")
+        if current_first is None or first_timestamp < current_first:
+            field_entry["first"] = first_timestamp
+    if last_timestamp is not None:
+        current_last = field_entry.get("last")
+        if current_last is None or last_timestamp > current_last:
+            field_entry["last"] = last_timestamp
+
+
+def merge_catalogs(base_catalog: dict, other_catalog: dict) -> dict:
+    """
+    Merge a catalog into another one, keeping the union of devices and the widest
+    first/last timestamps.
+    Arguments
+    ---------
+    base_catalog - catalog updated in place
+    other_catalog - catalog to merge into base_catalog
+    Returns
+    ---------
+    base_catalog - merged catalog
+    """
+    base_catalog["refreshed_at"] = max(base_catalog["refreshed_at"], other_catalog["refreshed_at"])
+    for user, other_user_entry in other_catalog["users"].items():
+        user_entry = _get_or_create_user_entry(base_catalog, user)
+        for device in other_user_entry["devices"]:
+            if device not in user_entry["devices"]:
+                user_entry["devices"].append(device)
+        for measurement, fields in other_user_entry["timestamps"].items():
+            for field, field_entry in fields.items():
+                _update_timestamp_entry(user_entry, measurement, field,
+                                        field_entry.get("first"), field_entry.get("last"))
+    return base_catalog
+
+
+# ---------------- CATALOG PERSISTENCE ---------------- #
+
+
+def load_catalog(catalog_path: str) -> dict:
+    """
+    Load the user catalog from disk.
+    Arguments
+    ---------
+    catalog_path - path of the JSON catalog file
+    Returns
+    ---------
+    catalog - loaded catalog, or an empty catalog if the file is missing or unreadable
+    """
+    try:
+        with open(catalog_path) as catalog_file:
+            return json.load(catalog_file)
+    except (OSError, ValueError):
+        return create_empty_catalog()
+
+
+def save_catalog(catalog: dict, catalog_path: str):
+    """
+    Merge the catalog with the one on disk and atomically replace the file. The merge is done
+    under a file lock so that concurrent Airflow tasks do not lose each other's updates.
+    Arguments
+    ---------
+    catalog - catalog to save
+    catalog_path - path of the JSON catalog file
+    """
+    catalog_directory = os.path.dirname(catalog_path)
+    if catalog_directory and not os.path.exists(catalog_directory):
+        os.makedirs(catalog_directory)
+
+    with open(catalog_path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        merged_catalog = merge_catalogs(load_catalog(catalog_path), catalog)
+        temporary_path = catalog_path + ".tmp"
+        with open(temporary_path, "w") as catalog_file:
+            json.dump(merged_catalog, catalog_file)
+        os.replace(temporary_path, catalog_path)
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def is_catalog_expired(catalog: dict, ttl_seconds: float) -> bool:
+    """
+    Check whether the catalog has to be refreshed from InfluxDB.
+    Arguments
+    ---------
+    catalog - user catalog
+    ttl_seconds - maximum age of the catalog in seconds
+    Returns
+    ---------
+    is_expired (Boolean) - True if the last refresh is older than ttl_seconds
+    """
+    return time.time() - catalog["refreshed_at"] > ttl_seconds
+
+
+# ---------------- CATALOG REFRESH FROM INFLUXDB ---------------- #
+
+
+def parse_series_key(series_key: str) -> tuple:
+    """
+    Split an InfluxDB series key into its measurement and tags.
+    Arguments
+    ---------
+    series_key - series key returned by SHOW SERIES, ex : "RrInterval,device_address=xx,user=yy"
+    Returns
+    ---------
+    measurement, tags - measurement name and dictionary of tags
+    """
+    measurement, *tag_pairs = series_key.split(",")
+    tags = dict(tag_pair.split("=", 1) for tag_pair in tag_pairs)
+    return measurement, tags
+
+
+def build_catalog_from_influxdb(client, fields_by_measurement: dict = None) -> dict:
+    """
+    Build the user catalog from InfluxDB with one SHOW SERIES query and one last() query per
+    feature field grouped by user. Raw fields are not queried: scanning the raw measurements is
+    too expensive, their timestamps are kept up to date by the ingestion.
+    Arguments
+    ---------
+    client - influxDB client to connect to database.
+    fields_by_measurement - feature fields whose last timestamp is read, by measurement, ex :
+    {"MotionAccelerometer": ["energy_by_5s"]}
+    Returns
+    ---------
+    catalog - freshly built catalog
+    """
+    if fields_by_measurement is None:
+        fields_by_measurement = dict()
+    catalog = create_empty_catalog()
+
+    series_result_set = client.query("SHOW SERIES")
+    for point in series_result_set.get_points():
+        measurement, tags = parse_series_key(point["key"])
+        if USER_PARAM_NAME not in tags:
+            continue
+        user_entry = _get_or_create_user_entry(catalog, tags[USER_PARAM_NAME])
+        device = tags.get(DEVICE_PARAM_NAME)
+        if device is not None and device not in user_entry["devices"]:
+            user_entry["devices"].append(device)
+
+    for measurement, fields in fields_by_measurement.items():
+        for field in fields:
+            query = "SELECT last(\"{}\") FROM \"{}\" GROUP BY \"{}\"".format(field, measurement, USER_PARAM_NAME)
+            result_set = client.query(query, epoch="ns")
+            for (_, group_tags), points in result_set.items():
+                user_entry = _get_or_create_user_entry(catalog, group_tags[USER_PARAM_NAME])
+                for point in points:
+                    _update_timestamp_entry(user_entry, measurement, field, last_timestamp=point["time"])
+
+    catalog["refreshed_at"] = time.time()
+    return catalog
+
+
+def get_catalog(client, catalog_path: str, ttl_seconds: float, fields_by_measurement: dict = None) -> dict:
+    """
+    Load the user catalog, refreshing it from InfluxDB only when it is older than ttl_seconds.
+    The refresh queries InfluxDB for every feature field, so it is run in an Airflow task and
+    never while a DAG file is imported.
+    Arguments
+    ---------
+    client - influxDB client to connect to database.
+    catalog_path - path of the JSON catalog file
+    ttl_seconds - maximum age of the catalog in seconds
+    fields_by_measurement - feature fields whose last timestamp is read when the catalog is refreshed
+    Returns
+    ---------
+    catalog - up-to-date user catalog
+    """
+    catalog = load_catalog(catalog_path)
+    if is_catalog_expired(catalog, ttl_seconds):
+        print("[Refreshing user catalog from InfluxDB]")
+        catalog = build_catalog_from_influxdb(client, fields_by_measurement)
+        save_catalog(catalog, catalog_path)
+    return catalog
+
+
+# ---------------- CATALOG UPDATE AND LOOKUP ---------------- #
+
+
+def update_catalog_with_dataframe(catalog: dict, measurement: str, tags: dict, dataframe, fields: List[str] = None):
+    """
+    Update the catalog with a dataframe that has just been written into InfluxDB.
+    Arguments
+    ---------
+    catalog - user catalog updated in place
+    measurement - measurement the dataframe was written to
+    tags - tags the dataframe was written with
+    dataframe - pandas DataFrame with a datetime index
+    fields - fields of the dataframe to track, the raw fields of the measurement if None
+    """
+    if dataframe.empty:
+        return
+    user_entry = _get_or_create_user_entry(catalog, tags[USER_PARAM_NAME])
+    device = tags.get(DEVICE_PARAM_NAME)
+    if device is not None and device not in user_entry["devices"]:
+        user_entry["devices"].append(device)
+
+    if fields is None:
+        fields = RAW_CATALOG_FIELDS_BY_MEASUREMENT.get(measurement, [])
+    first_timestamp = int(dataframe.index.min().value)
+    last_timestamp = int(dataframe.index.max().value)
+    for field in fields:
+        if field in dataframe.columns:
+            _update_timestamp_entry(user_entry, measurement, field, first_timestamp, last_timestamp)
+
+
+def get_catalog_user_list(catalog: dict) -> List[str]:
+    """
+    Get the list of all distinct users in the catalog.
+    """
+    return list(catalog["users"].keys())
+
+
+def get_catalog_user_devices(catalog: dict, user: str) -> List[str]:
+    """
+    Get the list of devices of a user in the catalog.
+    """
+    return catalog["users"].get(user, {"devices": []})["devices"]
+
+
+def get_catalog_timestamp(catalog: dict, user: str, measurement: str, field: str, selector: str):
+    """
+    Get the first or last timestamp of a field for a user.
+    Arguments
+    ---------
+    catalog - user catalog
+    user - user id
+    measurement - measurement name
+    field - field name
+    selector - "first" or "last"
+    Returns
+    ---------
+    timestamp - timestamp in nanoseconds since epoch, or None if unknown
+    """
+    user_entry = catalog["users"].get(user)
+    if user_entry is None:
+        return None
+    return user_entry["timestamps"].get(measurement, dict()).get(field, dict()).get(selector)